@@ -3,10 +3,12 @@ import logging
 import sys
 from boto.emr.connection import EmrConnection
 from boto.emr.bootstrap_action import BootstrapAction
+from boto.emr.instance_group import InstanceGroup
 from boto.regioninfo import RegionInfo
 from boto.emr.step import StreamingStep
 from boto.emr.step import ScriptRunnerStep
 from boto.emr.step import JarStep
+from timeline import timeline
  
 #Class for launching an EMR cluster
  
@@ -23,6 +25,7 @@ class EmrManager(object):
             self.log_dir = parameters["log_dir"]
             self.emr_status_wait = parameters["emr_status_wait"]
             self.step_status_wait = parameters["step_status_wait"]
+            self.step_status_retries = parameters["step_status_retries"]
             self.emr_cluster_name = parameters["emr_cluster_name"]
         except:
             logging.error("Something went wrong initializing EmrManager")
@@ -35,29 +38,44 @@ class EmrManager(object):
 
         self.log_bucket_name = self.base_bucket + self.log_dir
  
-    #Method for launching the EMR cluster
-    def launch_cluster(self, master_type, slave_type, num_instances, ami_version):
+    #Method for launching the EMR cluster. artifacts is a list of (s3 path, local folder)
+    #copied to every node by the stage_script bootstrap action while the cluster is provisioned.
+    #When instance_groups (see build_instance_groups) are given, they replace master_type,
+    #slave_type and num_instances
+    def launch_cluster(self, master_type, slave_type, num_instances, ami_version, artifacts=None, stage_script=None, instance_groups=None):
         try:
+            bootstrap_actions = []
+            if artifacts:
+                stage_args = []
+                for s3_path, local_folder in artifacts:
+                    stage_args += [s3_path, local_folder]
+                logging.info("Staging artifacts in every node with bootstrap action " + stage_script + ": " + str(artifacts))
+                bootstrap_actions.append(BootstrapAction("Stage artifacts", stage_script, stage_args))
             #Launching the cluster
-            cluster_id = self.connection.run_jobflow(
-                             self.emr_cluster_name,
-                             self.log_bucket_name,
-                             ec2_keyname=self.ec2_keypair_name,
-                             keep_alive=True,
-                             action_on_failure = 'CANCEL_AND_WAIT',
-                             master_instance_type=master_type,
-                             slave_instance_type=slave_type,
-                             num_instances=num_instances,
-                             ami_version=ami_version)
+            with timeline.span("emr.run_jobflow", bootstrap_actions=len(bootstrap_actions), instance_groups=len(instance_groups or [])):
+                cluster_id = self.connection.run_jobflow(
+                                 self.emr_cluster_name,
+                                 self.log_bucket_name,
+                                 ec2_keyname=self.ec2_keypair_name,
+                                 keep_alive=True,
+                                 action_on_failure = 'CANCEL_AND_WAIT',
+                                 master_instance_type=master_type,
+                                 slave_instance_type=slave_type,
+                                 num_instances=num_instances,
+                                 ami_version=ami_version,
+                                 bootstrap_actions=bootstrap_actions,
+                                 instance_groups=instance_groups)
 
             logging.info("Launching cluster: " + cluster_id + ". Please be patient. Check the status of your cluster in your AWS Console")
 
             # Checking the state of EMR cluster
-            state = self.connection.describe_jobflow(cluster_id).state
+            state = self._describe_jobflow(cluster_id).state
             while state != u'COMPLETED' and state != u'SHUTTING_DOWN' and state != u'FAILED' and state != u'WAITING':
                 #sleeping to recheck for status.
-                time.sleep(int(self.emr_status_wait))
-                state = self.connection.describe_jobflow(cluster_id).state
+                with timeline.span("emr.poll_cluster", cluster_id=cluster_id) as span:
+                    time.sleep(float(self.emr_status_wait))
+                    state = self._describe_jobflow(cluster_id).state
+                    span.set("state", state)
                 logging.info("Creating cluster " + cluster_id + ". Status: " + state)
  
             if state == u'SHUTTING_DOWN' or state == u'FAILED':
@@ -67,7 +85,7 @@ class EmrManager(object):
             #Check if the state is WAITING. Then launch the next steps
             if state == u'WAITING':
                 #Finding the master node dns of EMR cluster
-                master_dns = self.connection.describe_jobflow(cluster_id).masterpublicdnsname
+                master_dns = self._describe_jobflow(cluster_id).masterpublicdnsname
                 logging.info("Launched EMR Cluster Successfully with cluster id:" + cluster_id)
                 logging.info("Master node DNS of EMR " + master_dns)
                 return cluster_id
@@ -89,23 +107,7 @@ class EmrManager(object):
     # run streaming step in cluster
     def run_streaming_step(self, cluster_id, name, mapper_path, reducer_path, input_path, output_path):
         try:
-            # bundle files with the job
-            files = []
-            if mapper_path != "NONE":
-                files.append(mapper_path)
-                mapper_path = mapper_path.split("/")[-1]
-            if reducer_path != "NONE":
-                files.append(reducer_path)
-                reducer_path = reducer_path.split("/")[-1]
-            # build streaming step
-            logging.debug("Launching streaming step with mapper: " + mapper_path + " reducer: " + reducer_path + " and files: " + str(files))
-            step = StreamingStep(name=name,
-                                    step_args=["-files"] + files, 
-                                    mapper=mapper_path, 
-                                    reducer=reducer_path, 
-                                    input=input_path, 
-                                    output=output_path, 
-                                    action_on_failure="CONTINUE")
+            step = self.build_streaming_step(name, mapper_path, reducer_path, input_path, output_path)
             return self._run_step(cluster_id, step)            
         except:
             logging.error("Running streaming step in cluster " + cluster_id + " failed.")
@@ -114,20 +116,98 @@ class EmrManager(object):
     # run mapreduce jar step in cluster
     def run_jar_step(self, cluster_id, name, jar_path, class_name, input_path, output_path):
         try:
-            # build streaming step
-            logging.debug("Launching jar step with jar: " + jar_path + " class name: " + class_name + " input: " + input_path + " and output: " + output_path)
-            step = JarStep(name=name,
-                            jar=jar_path, 
-                            step_args= [class_name,
-                                        input_path,
-                                        output_path])
+            step = self.build_jar_step(name, jar_path, class_name, input_path, output_path)
             return self._run_step(cluster_id, step)            
         except:
             logging.error("Running jar step in cluster " + cluster_id + " failed.")
             return "FAILED"
 
+    # build streaming step
+    def build_streaming_step(self, name, mapper_path, reducer_path, input_path, output_path):
+        # bundle files with the job
+        files = []
+        if mapper_path != "NONE":
+            files.append(mapper_path)
+            mapper_path = mapper_path.split("/")[-1]
+        if reducer_path != "NONE":
+            files.append(reducer_path)
+            reducer_path = reducer_path.split("/")[-1]
+        logging.debug("Launching streaming step with mapper: " + mapper_path + " reducer: " + reducer_path + " and files: " + str(files))
+        return StreamingStep(name=name,
+                                step_args=["-files"] + files, 
+                                mapper=mapper_path, 
+                                reducer=reducer_path, 
+                                input=input_path, 
+                                output=output_path, 
+                                action_on_failure="CONTINUE")
+
+    # build mapreduce jar step
+    def build_jar_step(self, name, jar_path, class_name, input_path, output_path):
+        logging.debug("Launching jar step with jar: " + jar_path + " class name: " + class_name + " input: " + input_path + " and output: " + output_path)
+        return JarStep(name=name,
+                        jar=jar_path, 
+                        step_args= [class_name,
+                                    input_path,
+                                    output_path])
+
+    # run several steps in cluster, keeping at most max_active of them submitted
+    # and not finished, so the cluster always has the next step queued.
+    # on_step_finished(name, step_id, state) is called as soon as each step
+    # reaches a final state. Returns a dict of step name -> final state.
+    # When the steps can't be listed step_status_retries times in a row (e.g.
+    # the cluster is gone), the active and pending steps end in ERROR.
+    def run_steps(self, cluster_id, steps, max_active, on_step_finished=None):
+        pending = list(steps)
+        active = {}
+        states = {}
+        failed_polls = 0
+        while pending or active:
+            while pending and len(active) < max_active:
+                step = pending.pop(0)
+                with timeline.span("emr.add_jobflow_steps", cluster_id=cluster_id):
+                    step_id = self.connection.add_jobflow_steps(cluster_id, [step]).stepids[0].value
+                logging.info("Submitted step " + step.name + " (" + step_id + ") to cluster " + cluster_id)
+                active[step_id] = step.name
+            # one list_steps call per poll for all active steps
+            with timeline.span("emr.poll_step", cluster_id=cluster_id, active=len(active)):
+                time.sleep(float(self.step_status_wait))
+                step_states = self._find_step_states(cluster_id)
+            if step_states is None:
+                failed_polls += 1
+                if failed_polls <= self.step_status_retries:
+                    logging.error("Could not list steps in cluster " + cluster_id + ". Retrying.")
+                    continue
+                logging.error("Could not list steps in cluster " + cluster_id + " after " + str(failed_polls) + " attempts. Giving up")
+                for step_id, name in active.items():
+                    states[name] = u'ERROR'
+                    if on_step_finished:
+                        on_step_finished(name, step_id, u'ERROR')
+                for step in pending:
+                    states[step.name] = u'ERROR'
+                return states
+            failed_polls = 0
+            for step_id in list(active):
+                state = step_states.get(step_id, u'NOT_FOUND')
+                if state in (u'COMPLETED', u'FAILED', u'CANCELLED', u'INTERRUPTED', u'NOT_FOUND'):
+                    name = active.pop(step_id)
+                    states[name] = state
+                    if state == u'COMPLETED':
+                        logging.info("Step " + name + " (" + step_id + ") succesfully completed in cluster: " + cluster_id)
+                    else:
+                        logging.error("Step " + name + " (" + step_id + ") finished with state " + state + " in cluster: " + cluster_id)
+                    if on_step_finished:
+                        on_step_finished(name, step_id, state)
+        return states
+
     def _run_step(self, cluster_id, step):
-        step_list = self.connection.add_jobflow_steps(cluster_id, [step])
+        with timeline.span("emr.step", cluster_id=cluster_id, step_name=step.name) as span:
+            step_id = self._wait_for_step(cluster_id, step)
+            span.set("step_id", step_id)
+            return step_id
+
+    def _wait_for_step(self, cluster_id, step):
+        with timeline.span("emr.add_jobflow_steps", cluster_id=cluster_id):
+            step_list = self.connection.add_jobflow_steps(cluster_id, [step])
         step_id = step_list.stepids[0].value
 
         logging.info("Starting step " + step_id + " in cluster " + cluster_id + ". Please be patient. Check the progress of the job in your AWS Console")
@@ -136,8 +216,10 @@ class EmrManager(object):
         state = self._find_step_state(cluster_id, step_id)
         while state != u'NOT_FOUND' and state != u'ERROR' and state != u'FAILED' and state!=u'COMPLETED':
             #sleeping to recheck for status.
-            time.sleep(int(self.step_status_wait))
-            state = self._find_step_state(cluster_id, step_id)
+            with timeline.span("emr.poll_step", cluster_id=cluster_id, step_id=step_id) as span:
+                time.sleep(float(self.step_status_wait))
+                state = self._find_step_state(cluster_id, step_id)
+                span.set("state", state)
             logging.info("Starting step " + step_id + " in cluster " + cluster_id + ". Status: " + state)
 
         if state == u'FAILED':
@@ -158,15 +240,74 @@ class EmrManager(object):
 
 
     def _find_step_state(self, cluster_id, step_id):
+        step_states = self._find_step_states(cluster_id)
+        if step_states is None:
+            return "ERROR"
+        return step_states.get(step_id, "NOT_FOUND")
+
+    # dict of step id -> state for the cluster's steps, None if they can't be listed
+    def _find_step_states(self, cluster_id):
         try:
-            step_summary_list = self.connection.list_steps(cluster_id)
-            for step_summary in step_summary_list.steps:
-                if step_summary.id == step_id:
-                    return step_summary.status.state
-            return "NOT_FOUND"
+            with timeline.span("emr.list_steps", cluster_id=cluster_id):
+                step_summary_list = self.connection.list_steps(cluster_id)
+            return dict((step_summary.id, step_summary.status.state) for step_summary in step_summary_list.steps)
         except:
-            return "ERROR"
+            return None
+
+    # Instance groups for launch_cluster: an on-demand master, core_count on-demand core
+    # nodes and, if task_count > 0, a task group that runs on spot instances when a
+    # bid price (in USD/hour, as a string) is given
+    def build_instance_groups(self, master_type, core_type, core_count, task_type=None, task_count=0, task_bid_price=None):
+        instance_groups = [InstanceGroup(1, "MASTER", master_type, "ON_DEMAND", "Master"),
+                           InstanceGroup(core_count, "CORE", core_type, "ON_DEMAND", "Core")]
+        if task_count > 0:
+            instance_groups.append(self._task_group(task_type, task_count, task_bid_price))
+        return instance_groups
+
+    # Resizes the task group of a running cluster (e.g. grow it before a heavy step
+    # and shrink it afterwards). The group is created with task_type and task_bid_price
+    # if the cluster has none. New nodes join the running steps as they come up.
+    # Returns the task group id, or "FAILED"
+    def resize_task_group(self, cluster_id, size, task_type=None, task_bid_price=None):
+        try:
+            with timeline.span("emr.list_instance_groups", cluster_id=cluster_id):
+                instance_groups = self.connection.list_instance_groups(cluster_id).instancegroups
+            task_groups = [group for group in instance_groups if group.instancegrouptype == u'TASK']
+            if task_groups:
+                group_id = task_groups[0].id
+                logging.info("Resizing task group " + group_id + " in cluster " + cluster_id + " from " + str(task_groups[0].requestedinstancecount) + " to " + str(size) + " instances")
+                with timeline.span("emr.modify_instance_groups", cluster_id=cluster_id, size=size):
+                    self.connection.modify_instance_groups([group_id], [size])
+                return group_id
+            if size == 0:
+                logging.info("Cluster " + cluster_id + " has no task group to shrink")
+                return None
+            logging.info("Adding task group of " + str(size) + " " + task_type + " instances to cluster " + cluster_id)
+            with timeline.span("emr.add_instance_groups", cluster_id=cluster_id, size=size):
+                response = self.connection.add_instance_groups(cluster_id, [self._task_group(task_type, size, task_bid_price)])
+            return response.instancegroupids
+        except:
+            logging.error("Resizing task group in cluster " + cluster_id + " failed.")
+            return "FAILED"
+
+    def _task_group(self, task_type, task_count, task_bid_price):
+        if task_bid_price:
+            return InstanceGroup(task_count, "TASK", task_type, "SPOT", "Task (spot)", task_bid_price)
+        return InstanceGroup(task_count, "TASK", task_type, "ON_DEMAND", "Task")
+
+    # Returns the state of the cluster, None if it can't be described
+    def cluster_state(self, cluster_id):
+        try:
+            return self._describe_jobflow(cluster_id).state
+        except:
+            logging.error("Describing cluster " + cluster_id + " failed.")
+            return None
 
     #Method for terminating the EMR cluster
     def terminate_cluster(self, cluster_id):
-        self.connection.terminate_jobflow(cluster_id)
+        with timeline.span("emr.terminate_jobflow", cluster_id=cluster_id):
+            self.connection.terminate_jobflow(cluster_id)
+
+    def _describe_jobflow(self, cluster_id):
+        with timeline.span("emr.describe_jobflow", cluster_id=cluster_id):
+            return self.connection.describe_jobflow(cluster_id)
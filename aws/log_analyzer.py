@@ -0,0 +1,348 @@
+import calendar
+import json
+import logging
+import re
+import sys
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+from timeline import timeline
+
+# Builds a performance report of an EMR step from the logs the cluster
+# pushes to its log_uri (<bucket><log_dir>/<cluster id>/):
+#   - steps/<step id>/syslog: ids of the jobs the step ran
+#   - task-attempts/<application id>/<container id>/syslog: one per task
+#     attempt, with its input split and when it started processing it,
+#     started committing its output and finished
+#   - jobs/ or hadoop-mapreduce/history/: job history (.jhist), with the
+#     start, finish, host, status and counters of every attempt
+# Logs are fetched by parallel workers and parsed while they are streamed,
+# so no log is held in memory whole.
+#
+# EMR pushes the logs every few minutes, so right after a step finishes some
+# of them may be missing. The report lists what was not found.
+
+TIMESTAMP_RE = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),(\d{3}) ")
+ATTEMPT_RE = re.compile(r"attempt_\d+_\d+_[mr]_\d+_\d+")
+SPLIT_RE = re.compile(r"Processing split: .*:\d+\+(\d+)\s*$")
+JOB_RE = re.compile(r"\bjob_(\d+_\d+)\b")
+JOB_HISTORY_FOLDERS = ["jobs/", "hadoop-mapreduce/history/"]
+ATTEMPT_EVENTS = {
+    "MAP_ATTEMPT_STARTED": "started", "REDUCE_ATTEMPT_STARTED": "started",
+    "MAP_ATTEMPT_FINISHED": "finished", "REDUCE_ATTEMPT_FINISHED": "finished",
+    "MAP_ATTEMPT_FAILED": "unsuccessful", "REDUCE_ATTEMPT_FAILED": "unsuccessful",
+    "MAP_ATTEMPT_KILLED": "unsuccessful", "REDUCE_ATTEMPT_KILLED": "unsuccessful"
+}
+
+
+class LogAnalyzer(object):
+
+    # Default constructor of the class. create_s3 returns a new S3Manager;
+    # every worker thread gets its own, as boto connections aren't thread safe.
+    def __init__(self, parameters, create_s3):
+        try:
+            self.bucket_name = parameters["bucket_name"]
+            self.log_dir = parameters["log_dir"]
+            self.workers = parameters["workers"]
+            self.straggler_factor = parameters["straggler_factor"]
+        except:
+            logging.error("Something went wrong initializing LogAnalyzer")
+            sys.exit()
+        self.create_s3 = create_s3
+        self.local = threading.local()
+
+    # Returns the performance report of a step, None if its logs can't be read
+    def analyze_step(self, cluster_id, step_id):
+        with timeline.span("logs.analyze_step", cluster_id=cluster_id, step_id=step_id) as span:
+            start = time.time()
+            prefix = self.log_dir.strip("/") + "/" + cluster_id + "/"
+            try:
+                step_logs = [name for name, size in self._s3().list_keys(self.bucket_name, prefix + "steps/" + step_id + "/")
+                             if name.rsplit("/", 1)[-1] in ("syslog", "syslog.gz")]
+                job_ids = set()
+                for name in step_logs:
+                    job_ids.update(parse_step_syslog(self._lines(name)))
+                pool = ThreadPool(self.workers)
+                try:
+                    prefixes = [prefix + "task-attempts/application_" + job_id + "/" for job_id in sorted(job_ids)]
+                    prefixes += [prefix + folder for folder in JOB_HISTORY_FOLDERS]
+                    listed = [key for keys in pool.map(self._list, prefixes) for key in keys]
+                    logs = [(name, size) for name, size in listed
+                            if name.rsplit("/", 1)[-1] in ("syslog", "syslog.gz") and "/task-attempts/" in name]
+                    logs += [(name, size) for name, size in listed
+                             if re.search(r"\.jhist(\.gz)?$", name) and any(("job_" + job_id) in name for job_id in job_ids)]
+                    parsed = pool.map(self._parse, [name for name, size in logs])
+                finally:
+                    pool.close()
+                    pool.join()
+            except Exception as e:
+                logging.error("Could not read the logs of step " + step_id + " in cluster " + cluster_id + ": " + str(e))
+                return None
+            histories = [result for kind, result in parsed if kind == "history"]
+            attempts = [result for kind, result in parsed if kind == "attempt" and result]
+            missing = []
+            if not step_logs:
+                missing.append("step syslog")
+            if not histories:
+                missing.append("job history")
+            if not attempts:
+                missing.append("task attempt logs")
+            report = build_report(cluster_id, step_id, sorted("job_" + job_id for job_id in job_ids),
+                                  histories, attempts, self.straggler_factor)
+            report["logs"] = {
+                "files": len(step_logs) + len(logs),
+                "bytes": sum(size for name, size in logs),
+                "seconds": time.time() - start,
+                "missing": missing
+            }
+            span.set("files", report["logs"]["files"])
+            return report
+
+    # Human readable lines of a report
+    def format_report(self, report):
+        summary = report["summary"]
+        lines = ["Step " + report["step_id"] + " (" + (", ".join(report["job_ids"]) or "no jobs found") + "): " +
+                 "%d maps, %d reduces, %d failed and %d killed attempts" % (
+                     summary["maps"], summary["reduces"], summary["failed_attempts"], summary["killed_attempts"])]
+        logs = report.get("logs")
+        if logs:
+            lines.append("Logs: %d files, %s read in %.1fs" % (logs["files"], _megabytes(logs["bytes"]), logs["seconds"]) +
+                         (". Missing: " + ", ".join(logs["missing"]) if logs["missing"] else ""))
+        for job in report["jobs"]:
+            lines.append("Job %s %s in %s, launched after %s" % (job["job_id"], job["status"], _seconds(job["duration"]), _seconds(job["launch_delay"])))
+        for label, field, unit in (("Map duration", "map_duration", _seconds), ("Split size", "split_bytes", _megabytes)):
+            distribution = summary[field]
+            if distribution:
+                lines.append("%s: min %s  median %s  p90 %s  max %s" % (label, unit(distribution["min"]), unit(distribution["median"]),
+                                                                        unit(distribution["p90"]), unit(distribution["max"])))
+        phases = summary["map_phases"]
+        total = sum(phases.values())
+        if total:
+            lines.append("Time in maps: " + "  ".join("%s %s (%.0f%%)" % (label, _seconds(phases[phase]), 100.0 * phases[phase] / total)
+                                                      for label, phase in (("setup", "setup"), ("map", "process"), ("output commit", "commit"))))
+        if report["stragglers"]:
+            lines.append("Stragglers (over %.1fx the median map duration):" % report["straggler_factor"])
+            for attempt in report["stragglers"]:
+                lines.append("  %s %s on %s: split %s, setup %s, map %s, output commit %s" % (
+                    attempt["attempt_id"], _seconds(attempt["duration"]), attempt.get("host") or "unknown host",
+                    _megabytes(attempt.get("split_bytes")), _seconds(attempt.get("setup")),
+                    _seconds(attempt.get("process")), _seconds(attempt.get("commit"))))
+        return lines
+
+    def _s3(self):
+        if not hasattr(self.local, "s3"):
+            self.local.s3 = self.create_s3()
+        return self.local.s3
+
+    def _list(self, prefix):
+        return self._s3().list_keys(self.bucket_name, prefix)
+
+    def _lines(self, key_name):
+        return stream_lines(self._s3().read_key(self.bucket_name, key_name), key_name.endswith(".gz"))
+
+    def _parse(self, key_name):
+        if ".jhist" in key_name:
+            return ("history", parse_job_history(self._lines(key_name)))
+        return ("attempt", parse_task_syslog(self._lines(key_name)))
+
+
+# Lines of a (gzipped) log given as chunks of bytes
+def stream_lines(chunks, compressed):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if compressed else None
+    pending = ""
+    for chunk in chunks:
+        if decompressor:
+            data = decompressor.decompress(chunk)
+            # logs can be several gzip members one after the other
+            while decompressor.unused_data:
+                rest = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data += decompressor.decompress(rest)
+            chunk = data
+        lines = (pending + chunk).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+# Ids (without the job_ prefix) of the jobs a step submitted
+def parse_step_syslog(lines):
+    job_ids = set()
+    for line in lines:
+        if "job_" in line:
+            job_ids.update(JOB_RE.findall(line))
+    return job_ids
+
+
+# Seconds since the epoch of a log line timestamp (EMR nodes log in UTC)
+def _timestamp(match):
+    return calendar.timegm(time.strptime(match.group(1), "%Y-%m-%d %H:%M:%S")) + int(match.group(2)) / 1000.0
+
+
+# Phases of a task attempt from its syslog, None if it isn't a task attempt
+# log (e.g. the application master's)
+def parse_task_syslog(lines):
+    first = None
+    last = None
+    attempt = {"attempt_id": None, "split_bytes": None, "processing": None, "committing": None, "done": None}
+    for line in lines:
+        match = TIMESTAMP_RE.match(line)
+        if not match:
+            continue
+        if first is None:
+            first = match
+        last = match
+        if "Processing split: " in line:
+            split = SPLIT_RE.search(line)
+            if split:
+                attempt["split_bytes"] = int(split.group(1))
+            attempt["processing"] = _timestamp(match)
+        elif "is in the process of committing" in line:
+            attempt["committing"] = _timestamp(match)
+            attempt["attempt_id"] = attempt["attempt_id"] or ATTEMPT_RE.search(line).group(0)
+        elif "' done." in line and ATTEMPT_RE.search(line):
+            attempt["done"] = _timestamp(match)
+            attempt["attempt_id"] = ATTEMPT_RE.search(line).group(0)
+    if attempt["attempt_id"] is None:
+        return None
+    attempt["first"] = _timestamp(first)
+    attempt["last"] = _timestamp(last)
+    return attempt
+
+
+# Avro JSON wraps nullable fields as {"string": value}
+def _avro(value):
+    if isinstance(value, dict) and len(value) == 1 and list(value)[0] in ("string", "int", "long", "boolean"):
+        return list(value.values())[0]
+    return value
+
+
+def _counter(counters, group_name, counter_name):
+    for group in (_avro(counters) or {}).get("groups", []):
+        if group["name"] == group_name:
+            for count in group["counts"]:
+                if count["name"] == counter_name:
+                    return count["value"]
+    return None
+
+
+# Job times and attempts (by id) from a job history file
+def parse_job_history(lines):
+    history = {"job_id": None, "submit_time": None, "launch_time": None, "finish_time": None, "status": None, "attempts": {}}
+    for line in lines:
+        if not line.startswith("{\"type\":"):
+            continue
+        event = json.loads(line)
+        if not isinstance(event.get("event"), dict):
+            continue
+        kind = event["type"]
+        fields = dict((name, _avro(value)) for name, value in list(event["event"].values())[0].items())
+        if kind == "JOB_SUBMITTED":
+            history["job_id"] = fields["jobid"]
+            history["submit_time"] = fields["submitTime"] / 1000.0
+        elif kind == "JOB_INITED":
+            history["launch_time"] = fields["launchTime"] / 1000.0
+        elif kind in ("JOB_FINISHED", "JOB_FAILED", "JOB_KILLED"):
+            history["finish_time"] = fields["finishTime"] / 1000.0
+            history["status"] = fields.get("jobStatus", "SUCCEEDED")
+        elif kind in ATTEMPT_EVENTS:
+            attempt = history["attempts"].setdefault(fields["attemptId"], {"attempt_id": fields["attemptId"]})
+            attempt["task_id"] = fields["taskid"]
+            attempt["type"] = fields["taskType"]
+            if ATTEMPT_EVENTS[kind] == "started":
+                attempt["start"] = fields["startTime"] / 1000.0
+            else:
+                attempt["finish"] = fields["finishTime"] / 1000.0
+                attempt["host"] = fields.get("hostname")
+                attempt["status"] = fields.get("taskStatus") or fields.get("status")
+                counters = fields.get("counters")
+                attempt["input_bytes"] = _counter(counters, "org.apache.hadoop.mapreduce.lib.input.FileInputFormatCounter", "BYTES_READ")
+                attempt["input_records"] = _counter(counters, "org.apache.hadoop.mapreduce.TaskCounter", "MAP_INPUT_RECORDS")
+    return history
+
+
+# Value at the given fraction (0-1) of a sorted list
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _distribution(values):
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    return {"min": values[0], "median": _percentile(values, 0.5), "p90": _percentile(values, 0.9), "max": values[-1]}
+
+
+def _interval(start, end):
+    if start is None or end is None:
+        return None
+    return max(0.0, end - start)
+
+
+# Joins the job histories and task attempt logs of a step into its report
+def build_report(cluster_id, step_id, job_ids, histories, task_logs, straggler_factor):
+    attempts = {}
+    for history in histories:
+        for attempt_id, attempt in history["attempts"].items():
+            attempts[attempt_id] = dict(attempt)
+    for task_log in task_logs:
+        attempt = attempts.setdefault(task_log["attempt_id"], {
+            "attempt_id": task_log["attempt_id"],
+            "task_id": "task_" + task_log["attempt_id"][len("attempt_"):].rsplit("_", 1)[0],
+            "type": "MAP" if "_m_" in task_log["attempt_id"] else "REDUCE",
+            "status": "SUCCEEDED" if task_log["done"] else None
+        })
+        attempt["split_bytes"] = task_log["split_bytes"]
+        # without job history, the attempt is timed from its own log
+        start = attempt.setdefault("start", task_log["first"])
+        attempt.setdefault("finish", task_log["done"] or task_log["last"])
+        attempt["setup"] = _interval(start, task_log["processing"] or task_log["first"])
+        attempt["process"] = _interval(task_log["processing"] or task_log["first"], task_log["committing"])
+        attempt["commit"] = _interval(task_log["committing"], task_log["done"])
+    for attempt in attempts.values():
+        attempt["duration"] = _interval(attempt.get("start"), attempt.get("finish"))
+    ordered = sorted(attempts.values(), key=lambda attempt: attempt["duration"] or 0, reverse=True)
+    succeeded = [attempt for attempt in ordered if attempt.get("status") == "SUCCEEDED"]
+    maps = [attempt for attempt in succeeded if attempt["type"] == "MAP"]
+    durations = _distribution(attempt["duration"] for attempt in maps)
+    stragglers = []
+    if durations:
+        stragglers = [attempt for attempt in maps if attempt["duration"] > straggler_factor * durations["median"]]
+    phases = dict((phase, sum(attempt.get(phase) or 0.0 for attempt in maps)) for phase in ("setup", "process", "commit"))
+    jobs = []
+    for history in histories:
+        jobs.append({
+            "job_id": history["job_id"],
+            "status": history["status"],
+            "duration": _interval(history["submit_time"], history["finish_time"]),
+            "launch_delay": _interval(history["submit_time"], history["launch_time"])
+        })
+    return {
+        "cluster_id": cluster_id,
+        "step_id": step_id,
+        "job_ids": job_ids,
+        "jobs": jobs,
+        "summary": {
+            "maps": len(maps),
+            "reduces": len([attempt for attempt in succeeded if attempt["type"] == "REDUCE"]),
+            "failed_attempts": len([attempt for attempt in ordered if attempt.get("status") == "FAILED"]),
+            "killed_attempts": len([attempt for attempt in ordered if attempt.get("status") == "KILLED"]),
+            "map_duration": durations,
+            "split_bytes": _distribution(attempt.get("split_bytes") for attempt in maps),
+            "map_phases": phases
+        },
+        "straggler_factor": straggler_factor,
+        "stragglers": stragglers,
+        "attempts": ordered
+    }
+
+
+def _seconds(value):
+    return "-" if value is None else "%.1fs" % value
+
+
+def _megabytes(value):
+    return "-" if value is None else "%.1f MB" % (value / 1024.0 / 1024.0)
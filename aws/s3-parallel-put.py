@@ -27,26 +27,50 @@ try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
+from bz2 import BZ2File
+from collections import deque
 from gzip import GzipFile
+import hashlib
+import heapq
 from itertools import chain, imap, islice
 import logging
-from multiprocessing import JoinableQueue, Process, current_process
+from multiprocessing import JoinableQueue, Lock, Process, current_process
+from multiprocessing.managers import SyncManager
+from multiprocessing.pool import ThreadPool
 from optparse import OptionGroup, OptionParser
 import os.path
 import re
+import shutil
+import signal
 from ssl import SSLError
+import stat
 import sys
 import tarfile
+import tempfile
+import threading
 import time
 import mimetypes
 
 from boto.s3.connection import S3Connection
 from boto.s3.acl import CannedACLStrings
+from boto.s3.multipart import MultiPartUpload
 from boto.utils import compute_md5
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 
 DONE_RE = re.compile(r'\AINFO:s3-parallel-put\[putter-\d+\]:\S+\s+->\s+(\S+)\s*\Z')
 
+COMPRESSED_TAR_OPENERS = (('\x1f\x8b', GzipFile), ('BZh', BZ2File))
+SPOOL_BUFFER_SIZE = 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
 
 def repeatedly(func, *args, **kwargs):
     while True:
@@ -74,7 +98,8 @@ class FileObjectCache(object):
 
 class Value(object):
 
-    def __init__(self, file_object_cache, content=None, filename=None, md5=None, offset=None, path=None, size=None):
+    def __init__(self, file_object_cache, content=None, filename=None, md5=None, offset=None, path=None, size=None,
+                 part_size=None, part_number=None, part_count=None, upload_id=None):
         self.file_object_cache = file_object_cache
         self.content = content
         self.filename = filename
@@ -82,6 +107,11 @@ class Value(object):
         self.offset = offset
         self.path = path
         self.size = size
+        # set for files uploaded in parts (part_size) and for each of their parts
+        self.part_size = part_size
+        self.part_number = part_number
+        self.part_count = part_count
+        self.upload_id = upload_id
 
     def get_content(self):
         if self.content is None:
@@ -101,6 +131,22 @@ class Value(object):
             self.md5 = compute_md5(StringIO(self.get_content()))
         return self.md5
 
+    # ETag S3 gives to a multipart upload: the md5 of the md5s of its parts, and the number of parts
+    def calculate_multipart_etag(self):
+        part_md5s = []
+        with open(self.path, 'rb') as file_object:
+            for offset in xrange(0, self.get_size(), self.part_size):
+                md5 = hashlib.md5()
+                remaining = min(self.part_size, self.get_size() - offset)
+                while remaining > 0:
+                    data = file_object.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        break
+                    md5.update(data)
+                    remaining -= len(data)
+                part_md5s.append(md5.digest())
+        return '%s-%d' % (hashlib.md5(''.join(part_md5s)).hexdigest(), len(part_md5s))
+
     def get_size(self):
         if self.size is None:
             if self.content:
@@ -112,18 +158,59 @@ class Value(object):
         return self.size
 
 
+# Yields (path, size) for the files in dirpath and (path, None) for its
+# subdirectories, with at most one stat per entry. Like os.walk, symbolic
+# links to files are followed and symbolic links to directories are not.
+def list_directory(dirpath):
+    if scandir:
+        for entry in scandir(dirpath):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield (entry.path, None)
+                elif entry.is_file():
+                    yield (entry.path, entry.stat().st_size)
+            except OSError:
+                continue
+    else:
+        for name in os.listdir(dirpath):
+            path = os.path.join(dirpath, name)
+            try:
+                stat_result = os.lstat(path)
+                if stat.S_ISLNK(stat_result.st_mode):
+                    stat_result = os.stat(path)
+                elif stat.S_ISDIR(stat_result.st_mode):
+                    yield (path, None)
+                    continue
+            except OSError:
+                continue
+            if stat.S_ISREG(stat_result.st_mode):
+                yield (path, stat_result.st_size)
+
+
+# Yields (path, size) for the files under directory, skipping directories
+# that cannot be listed like os.walk does
+def scan_directory(directory):
+    directories = [directory]
+    while directories:
+        try:
+            entries = list(list_directory(directories.pop()))
+        except OSError:
+            continue
+        for path, size in entries:
+            if size is None:
+                directories.append(path)
+            else:
+                yield (path, size)
+
+
 def walk_filesystem(source, options):
     if os.path.isdir(source):
-        for dirpath, dirnames, filenames in os.walk(source):
-            for filename in filenames:
-                path = os.path.join(dirpath, filename)
-                if not os.path.isfile(path):
-                    continue
-                key_name = os.path.normpath(os.path.join(options.prefix, path))
-                yield (key_name, dict(path=path))
+        for path, size in scan_directory(source):
+            key_name = os.path.normpath(os.path.join(options.prefix, path))
+            yield (key_name, dict(path=path, size=size))
     elif os.path.isfile(source):
         key_name = os.path.normpath(os.path.join(options.prefix, source))
-        yield (key_name, dict(path=source))
+        yield (key_name, dict(path=source, size=os.path.getsize(source)))
 
 
 def walk_tar(source, options):
@@ -140,16 +227,57 @@ def walk_tar(source, options):
             # http://blogs.oucs.ox.ac.uk/inapickle/2011/06/20/high-memory-usage-when-using-pythons-tarfile-module/
             tar_file.members = []
     except tarfile.ReadError:
-        tar_file = tarfile.open(source)
+        for pair in walk_compressed_tar(source, options):
+            yield pair
+
+
+class SpoolingReader(object):
+
+    def __init__(self, file_object, spool_file):
+        self.file_object = file_object
+        self.spool_file = spool_file
+
+    def read(self, size=-1):
+        data = self.file_object.read(size)
+        self.spool_file.write(data)
+        return data
+
+
+def open_compressed_tar(source):
+    with open(source, 'rb') as file_object:
+        magic = file_object.read(3)
+    for prefix, opener in COMPRESSED_TAR_OPENERS:
+        if magic.startswith(prefix):
+            return opener(source)
+    raise tarfile.ReadError('%s is not a tar, tar.gz or tar.bz2 file' % source)
+
+
+# Decompresses the tarball once, streaming, into an uncompressed copy in the
+# spool directory. Members are yielded as offsets into that copy once their
+# data is written, so putters read them like members of an uncompressed tar
+# and no content goes through the put queue.
+def walk_compressed_tar(source, options):
+    spool_fd, spool_filename = tempfile.mkstemp(suffix='.tar', dir=options.spool_dir)
+    with open_compressed_tar(source) as compressed_file, os.fdopen(spool_fd, 'wb') as spool_file:
+        tar_file = tarfile.open(fileobj=SpoolingReader(compressed_file, spool_file), mode='r|', bufsize=SPOOL_BUFFER_SIZE)
+        pending = None
         for tarinfo in tar_file:
+            # the previous member's data has been read by now
+            if pending:
+                spool_file.flush()
+                yield pending
+                pending = None
             if tarinfo.isfile():
                 path = tarinfo.name
                 key_name = os.path.normpath(os.path.join(options.prefix, path))
-                content = tar_file.extractfile(tarinfo).read()
-                yield (key_name, dict(content=content, path=path))
+                pending = (key_name, dict(filename=spool_filename, offset=tarinfo.offset_data, path=path, size=tarinfo.size))
+            tar_file.members = []
+        spool_file.flush()
+        if pending:
+            yield pending
 
 
-def walker(walk, put_queue, sources, options):
+def walker(walk, put, put_queue, multipart_uploads, sources, options):
     logger = logging.getLogger('%s[walker-%d]' % (os.path.basename(sys.argv[0]), current_process().pid))
     pairs = chain(*imap(lambda source: walk(source, options), sources))
     if options.resume:
@@ -163,10 +291,79 @@ def walker(walk, put_queue, sources, options):
         pairs = ((key_name, args) for key_name, args in pairs if key_name not in done)
     if options.limit:
         pairs = islice(pairs, options.limit)
+    if options.walk == 'filesystem':
+        pairs = schedule(put, pairs, multipart_uploads, options, logger)
     for pair in pairs:
         put_queue.put(pair)
 
 
+# Queues files over the multipart threshold first, split into parts as soon
+# as their upload is initiated, so all putters share them, while the other
+# files stream behind them through a window of options.schedule_window files
+# that always releases its largest file first (longest processing time first
+# scheduling, within the window). Putters start on the first files walked and
+# the walker holds at most a window of files, at the price of an order that
+# is only sorted within the window. Whether a large file needs uploading
+# (hashing it in update mode) is checked by a pool of options.processes
+# threads, at most options.processes files at a time. Initiated uploads are
+# recorded in multipart_uploads (see abort_multipart_uploads).
+def schedule(put, pairs, multipart_uploads, options, logger):
+    window = []
+    pending = deque()
+    pool, connections = None, threading.local()
+    try:
+        for index, (key_name, value_kwargs) in enumerate(pairs):
+            size = value_kwargs['size']
+            if not options.multipart_threshold or size <= options.multipart_threshold or options.gzip:
+                # index keeps files of the same size in walk order
+                heapq.heappush(window, (-size, index, key_name, value_kwargs))
+                if len(window) > options.schedule_window:
+                    size, index, key_name, value_kwargs = heapq.heappop(window)
+                    yield (key_name, value_kwargs)
+            else:
+                if pool is None:
+                    pool = ThreadPool(options.processes)
+                pending.append(pool.apply_async(split_parts, (put, key_name, value_kwargs, multipart_uploads, connections, options, logger)))
+            while pending and (pending[0].ready() or len(pending) > options.processes):
+                for pair in pending.popleft().get():
+                    yield pair
+        while pending:
+            for pair in pending.popleft().get():
+                yield pair
+        while window:
+            size, index, key_name, value_kwargs = heapq.heappop(window)
+            yield (key_name, value_kwargs)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+# Checks whether a file over the multipart threshold needs uploading and if so
+# initiates its multipart upload, recording it in multipart_uploads. Returns
+# the pairs of its parts. Runs in the threads of schedule, each with its own
+# connection in connections
+def split_parts(put, key_name, value_kwargs, multipart_uploads, connections, options, logger):
+    if not hasattr(connections, 'bucket'):
+        connections.bucket = S3Connection(is_secure=options.secure, host=options.host).get_bucket(options.bucket)
+    bucket = connections.bucket
+    size = value_kwargs['size']
+    # S3 accepts at most MAX_PARTS parts
+    part_size = max(options.multipart_chunk_size, (size + MAX_PARTS - 1) // MAX_PARTS)
+    value = Value(None, part_size=part_size, **value_kwargs)
+    if not put(bucket, key_name, value):
+        logger.info('skipping %s -> %s' % (value.path, key_name))
+        return []
+    if options.dry_run:
+        upload_id = 'dry-run:' + key_name
+    else:
+        upload_id = bucket.initiate_multipart_upload(key_name, headers=put_headers(value, options), policy=options.grant).id
+        multipart_uploads[upload_id] = key_name
+    offsets = range(0, size, part_size)
+    return [(key_name, dict(filename=value.path, offset=offset, path=value.path, size=min(part_size, size - offset),
+                            part_number=part_number, part_count=len(offsets), upload_id=upload_id))
+            for part_number, offset in enumerate(offsets, 1)]
+
+
 def put_add(bucket, key_name, value):
     key = bucket.get_key(key_name)
     if key is None:
@@ -183,6 +380,11 @@ def put_update(bucket, key_name, value):
     key = bucket.get_key(key_name)
     if key is None:
         return bucket.new_key(key_name)
+    elif value.part_size:
+        if key.etag == '"%s"' % value.calculate_multipart_etag():
+            return None
+        else:
+            return key
     else:
         # Boto's md5 function actually returns 3-tuple: (hexdigest, base64, size)
         value.calculate_md5()
@@ -192,7 +394,57 @@ def put_update(bucket, key_name, value):
             return key
 
 
-def putter(put, put_queue, stat_queue, options):
+def put_headers(value, options):
+    if options.headers:
+        headers = dict(tuple(header.split(':', 1)) for header in options.headers)
+    else:
+        headers = {}
+    if options.content_type:
+        if options.content_type == "guess":
+            headers['Content-Type'] = mimetypes.guess_type(value.path)[0]
+        else:
+            headers['Content-Type'] = options.content_type
+    return headers
+
+
+# Uploads a part of a multipart upload and records its ETag in uploaded_parts,
+# shared by all putters. Whoever uploads the last part completes the upload
+# and removes it from multipart_uploads. Returns whether it did.
+def put_part(bucket, key_name, value, multipart_uploads, uploaded_parts, uploaded_parts_lock, options):
+    etag = None
+    if not options.dry_run:
+        multipart_upload = MultiPartUpload(bucket)
+        multipart_upload.key_name = key_name
+        multipart_upload.id = value.upload_id
+        part = multipart_upload.upload_part_from_file(StringIO(value.get_content()), value.part_number, md5=value.calculate_md5())
+        etag = part.etag
+    with uploaded_parts_lock:
+        parts = uploaded_parts.get(value.upload_id, {})
+        parts[value.part_number] = etag
+        uploaded_parts[value.upload_id] = parts
+    if len(parts) < value.part_count:
+        return False
+    if not options.dry_run:
+        xml = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % ''.join(
+            '<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' % (part_number, parts[part_number]) for part_number in sorted(parts))
+        bucket.complete_multipart_upload(key_name, value.upload_id, xml)
+        del multipart_uploads[value.upload_id]
+    return True
+
+
+# Aborts the multipart uploads left in multipart_uploads, the ones not
+# completed because a putter failed or the run was interrupted, so S3 doesn't
+# keep (and bill) their parts. A rerun starts them again under new upload ids
+def abort_multipart_uploads(multipart_uploads, options, logger):
+    if not len(multipart_uploads):
+        return
+    bucket = S3Connection(is_secure=options.secure, host=options.host).get_bucket(options.bucket)
+    for upload_id, key_name in multipart_uploads.items():
+        logger.warning('aborting incomplete multipart upload of %s' % key_name)
+        bucket.cancel_multipart_upload(key_name, upload_id)
+
+
+def putter(put, put_queue, stat_queue, multipart_uploads, uploaded_parts, uploaded_parts_lock, options):
     logger = logging.getLogger('%s[putter-%d]' % (os.path.basename(sys.argv[0]), current_process().pid))
     connection, bucket = None, None
     file_object_cache = FileObjectCache()
@@ -208,18 +460,18 @@ def putter(put, put_queue, stat_queue, options):
                 connection = S3Connection(is_secure=options.secure, host=options.host)
             if bucket is None:
                 bucket = connection.get_bucket(options.bucket)
+            if value.upload_id:
+                completed = put_part(bucket, key_name, value, multipart_uploads, uploaded_parts, uploaded_parts_lock, options)
+                logger.info('%s part %d/%d -> %s' % (value.path, value.part_number, value.part_count, key_name))
+                stat_queue.put(dict(size=value.get_size(), files=0))
+                if completed:
+                    logger.info('%s -> %s' % (value.path, key_name))
+                    stat_queue.put(dict(size=0))
+                put_queue.task_done()
+                continue
             key = put(bucket, key_name, value)
             if key:
-                if options.headers:
-                    headers = dict(tuple(header.split(':', 1)) for header in options.headers)
-                else:
-                    headers = {}
-                if options.content_type:
-                    if options.content_type == "guess":
-                        headers['Content-Type'] = mimetypes.guess_type(value.path)[0]
-                    else:
-                        headers['Content-Type'] = options.content_type
-
+                headers = put_headers(value, options)
                 content = value.get_content()
                 md5 = value.md5
                 if options.gzip:
@@ -251,7 +503,7 @@ def statter(stat_queue, start, options):
         if kwargs is None:
             stat_queue.task_done()
             break
-        count += 1
+        count += kwargs.get('files', 1)
         total_size += kwargs.get('size', 0)
         stat_queue.task_done()
     duration = time.time() - start
@@ -273,6 +525,8 @@ def main(argv):
     group = OptionGroup(parser, 'Source options')
     group.add_option('--walk', choices=('filesystem', 'tar'), default='filesystem', metavar='MODE',
             help='set walk mode (filesystem or tar)')
+    group.add_option('--spool-dir', metavar='DIRECTORY',
+            help='set where compressed tarballs are decompressed to, needs room for their uncompressed size (default: system temporary directory)')
     parser.add_option_group(group)
     group = OptionGroup(parser, 'Put options')
     group.add_option('--content-type', metavar='CONTENT-TYPE',
@@ -281,6 +535,12 @@ def main(argv):
             help='gzip values and set content encoding')
     group.add_option('--put', choices=('add', 'stupid', 'update'), default='update', metavar='MODE',
             help='set put mode (add, stupid, or update)')
+    group.add_option('--multipart-threshold', default=64 * 1024 * 1024, metavar='BYTES', type=int,
+            help='upload files larger than BYTES in parts shared by all putters, 0 to disable (filesystem walk only, not with --gzip)')
+    group.add_option('--multipart-chunk-size', default=16 * 1024 * 1024, metavar='BYTES', type=int,
+            help='set the size of multipart upload parts (at least 5 MB)')
+    group.add_option('--schedule-window', default=1024, metavar='N', type=int,
+            help='queue the largest of the next N files first (filesystem walk only)')
     group.add_option('--prefix', default='', metavar='PREFIX',
             help='set key prefix')
     group.add_option('--resume', action='append', default=[], metavar='FILENAME',
@@ -316,6 +576,9 @@ def main(argv):
     if not options.bucket:
         logger.error('missing bucket')
         return 1
+    if options.multipart_chunk_size < MIN_PART_SIZE:
+        logger.error('multipart chunk size must be at least %d bytes' % MIN_PART_SIZE)
+        return 1
     connection = S3Connection(is_secure=options.secure)
     bucket = connection.get_bucket(options.bucket)
     del bucket
@@ -324,25 +587,37 @@ def main(argv):
     put_queue = JoinableQueue(1024 * options.processes)
     stat_queue = JoinableQueue()
     walk = {'filesystem': walk_filesystem, 'tar': walk_tar}[options.walk]
-    walker_process = Process(target=walker, args=(walk, put_queue, args, options))
-    walker_process.start()
+    if options.walk == 'tar':
+        options.spool_dir = tempfile.mkdtemp(prefix='s3-parallel-put-', dir=options.spool_dir)
     put = {'add': put_add, 'stupid': put_stupid, 'update': put_update}[options.put]
-    putter_processes = list(islice(repeatedly(Process, target=putter, args=(put, put_queue, stat_queue, options)), options.processes))
-    for putter_process in putter_processes:
-        putter_process.start()
-    statter_process = Process(target=statter, args=(stat_queue, start, options))
-    statter_process.start()
-    walker_process.join()
-    for putter_process in putter_processes:
-        put_queue.put(None)
-    put_queue.close()
-    for putter_process in putter_processes:
-        putter_process.join()
-    stat_queue.put(None)
-    stat_queue.close()
-    statter_process.join()
-    put_queue.join_thread()
-    stat_queue.join_thread()
+    manager = SyncManager()
+    # ignores ^C, so the uploads to abort can still be read after an interruption
+    manager.start(signal.signal, (signal.SIGINT, signal.SIG_IGN))
+    multipart_uploads, uploaded_parts, uploaded_parts_lock = manager.dict(), manager.dict(), Lock()
+    try:
+        walker_process = Process(target=walker, args=(walk, put, put_queue, multipart_uploads, args, options))
+        walker_process.start()
+        putter_processes = list(islice(repeatedly(Process, target=putter, args=(put, put_queue, stat_queue, multipart_uploads, uploaded_parts, uploaded_parts_lock, options)), options.processes))
+        for putter_process in putter_processes:
+            putter_process.start()
+        statter_process = Process(target=statter, args=(stat_queue, start, options))
+        statter_process.start()
+        walker_process.join()
+        for putter_process in putter_processes:
+            put_queue.put(None)
+        put_queue.close()
+        for putter_process in putter_processes:
+            putter_process.join()
+        stat_queue.put(None)
+        stat_queue.close()
+        statter_process.join()
+        put_queue.join_thread()
+        stat_queue.join_thread()
+    finally:
+        abort_multipart_uploads(multipart_uploads, options, logger)
+        manager.shutdown()
+    if options.walk == 'tar':
+        shutil.rmtree(options.spool_dir, ignore_errors=True)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,9 @@
 import logging
+import os
+import re
 from boto.s3.connection import S3Connection
 from boto.s3.connection import Location
-from boto.s3.key import Key
+from timeline import timeline
 
 #Class for managing s3 buckets
 
@@ -21,30 +23,72 @@ class S3Manager(object):
 
     # Create a bucket in the default region
     def create_bucket(self, bucket_name, location = Location.EU):
-        return self.connection.create_bucket(bucket_name, location=location)
+        with timeline.span("s3.create_bucket", bucket=bucket_name):
+            return self.connection.create_bucket(bucket_name, location=location)
 
     # Delete a bucket in the default region. It has to be empty before it's deleted.
     def delete_bucket(self, bucket_name):
-        self.connection.delete_bucket(bucket_name)
+        with timeline.span("s3.delete_bucket", bucket=bucket_name):
+            self.connection.delete_bucket(bucket_name)
 
     # Returns a bucket by name
     def get_bucket(self, bucket_name):
-        return self.connection.get_bucket(bucket_name)
+        with timeline.span("s3.get_bucket", bucket=bucket_name):
+            return self.connection.get_bucket(bucket_name)
 
     # Upload a file to a bucket
     def upload_file(self, bucket_name, local_file_name, remote_file_name, callback=None):
-        theKey = Key(self.get_bucket(bucket_name))
-        theKey.key = remote_file_name
-        theKey.set_contents_from_filename(local_file_name, cb=callback, num_cb=1)
+        with timeline.span("s3.upload", bucket=bucket_name, key=remote_file_name, bytes=os.path.getsize(local_file_name)):
+            theKey = self.get_bucket(bucket_name).new_key(remote_file_name)
+            theKey.set_contents_from_filename(local_file_name, cb=callback, num_cb=1)
+
+    # Returns the etag of a key, None if it doesn't exist
+    def get_etag(self, bucket_name, key_name):
+        with timeline.span("s3.get_key", bucket=bucket_name, key=key_name):
+            key = self.get_bucket(bucket_name).get_key(key_name)
+        if key is None:
+            return None
+        return key.etag
+
+    # Returns a dict of key name -> etag for the keys under an s3:// or s3n:// path
+    def get_etags(self, path):
+        bucket_name, prefix = re.match(r"^s3n?://([^/]+)/?(.*)$", path).groups()
+        with timeline.span("s3.list", bucket=bucket_name, prefix=prefix) as span:
+            etags = dict((key.name, key.etag) for key in self.get_bucket(bucket_name).list(prefix = prefix))
+            span.set("keys", len(etags))
+        return etags
+
+    # Returns (name, size) of the keys under prefix
+    def list_keys(self, bucket_name, prefix):
+        with timeline.span("s3.list", bucket=bucket_name, prefix=prefix) as span:
+            keys = [(key.name, key.size) for key in self.connection.get_bucket(bucket_name, validate=False).list(prefix = prefix)]
+            span.set("keys", len(keys))
+        return keys
+
+    # Yields the contents of a key in chunks, so it is never held in memory whole. Yields nothing if it doesn't exist
+    def read_key(self, bucket_name, key_name, chunk_size=1024 * 1024):
+        with timeline.span("s3.download", bucket=bucket_name, key=key_name) as span:
+            key = self.connection.get_bucket(bucket_name, validate=False).get_key(key_name)
+            size = 0
+            if key is not None:
+                for chunk in iter(lambda: key.read(chunk_size), b""):
+                    size += len(chunk)
+                    yield chunk
+                key.close()
+            span.set("bytes", size)
 
     # Deletes all files with prefix
     def delete_files_with_prefix(self, bucket_name, prefix):
-        bucket = self.get_bucket(bucket_name)
-        keys_to_delete = bucket.list(prefix = prefix)
-        bucket.delete_keys([key.name for key in keys_to_delete])
+        with timeline.span("s3.delete_prefix", bucket=bucket_name, prefix=prefix) as span:
+            bucket = self.get_bucket(bucket_name)
+            keys_to_delete = [key.name for key in bucket.list(prefix = prefix)]
+            bucket.delete_keys(keys_to_delete)
+            span.set("keys", len(keys_to_delete))
 
     # Empties the contents of a bucket
     def empty_bucket(self, bucket_name):
-        bucket = self.get_bucket(bucket_name)
-        keys_to_delete = bucket.get_all_keys()
-        bucket.delete_keys([key.name for key in keys_to_delete])
+        with timeline.span("s3.empty_bucket", bucket=bucket_name) as span:
+            bucket = self.get_bucket(bucket_name)
+            keys_to_delete = [key.name for key in bucket.get_all_keys()]
+            bucket.delete_keys(keys_to_delete)
+            span.set("keys", len(keys_to_delete))
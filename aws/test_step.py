@@ -1,11 +1,24 @@
 import logging
-from boto.emr.step import StreamingStep
-from emr_manager import EmrManager
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import defaults
+from aws.emr_manager import EmrManager
+# the parameters the orchestrator builds its EmrManager with
+from orchestrator import emr_parameters
 
-# script to trigger a test step process
+# script to trigger a test streaming step in a running cluster
+# usage: python aws/test_step.py cluster_id
 logging.getLogger().setLevel(logging.INFO)
-manager = EmrManager()
-step = StreamingStep(name="testStep", mapper="s3n://tuiinnovation-holycrap/scripts/mapper.py", reducer="NONE", input="s3n://tuiinnovation-emr/input/SuppliersMonitor.log-20140524.bz2", output="s3n://tuiinnovation-emr/output/", action_on_failure="CONTINUE")
-cluster_id = "j-1OSKIJWRXGEJW"
-step_id = manager.run_step(cluster_id, step)
-logging.info("step " + step_id + " completed in " + cluster_id)
\ No newline at end of file
+if len(sys.argv) < 2:
+    logging.error("usage: python aws/test_step.py cluster_id")
+    sys.exit(1)
+manager = EmrManager(emr_parameters)
+cluster_id = sys.argv[1]
+step_id = manager.run_streaming_step(cluster_id = cluster_id,
+                                     name = "testStep",
+                                     mapper_path = defaults.step_mapper,
+                                     reducer_path = "NONE",
+                                     input_path = defaults.step_input,
+                                     output_path = defaults.step_output)
+logging.info("step " + step_id + " completed in " + cluster_id)
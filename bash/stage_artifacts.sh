@@ -0,0 +1,9 @@
+#!/bin/bash -xe
+# bootstrap action: copies artifacts to every node while the cluster is provisioned
+# usage: stage_artifacts.sh s3_path local_folder [s3_path local_folder ...]
+while [ $# -gt 1 ]; do
+    mkdir -p $2
+    hadoop fs -copyToLocal $1 $2
+    chmod +x $2/$(basename $1)
+    shift 2
+done
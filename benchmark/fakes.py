@@ -0,0 +1,357 @@
+import hashlib
+import io
+import re
+import threading
+import time
+from redshift.db_connection import DbConnection
+from timeline import timeline
+
+# In-process stand-ins for the AWS services used by the orchestrator. They
+# replace the boto connections inside S3Manager and EmrManager, so the
+# managers and the orchestrator run unchanged against them.
+
+
+class FakeObject(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+# Splits s3://bucket/prefix or s3n://bucket/prefix into (bucket, prefix)
+def split_s3_path(path):
+    match = re.match(r"^s3n?://([^/]+)/?(.*)$", path)
+    return match.group(1), match.group(2)
+
+
+# Output path of a boto streaming or jar step
+def step_output(step):
+    args = list(step.args())
+    if "-output" in args:
+        return args[args.index("-output") + 1]
+    return args[-1]
+
+
+# Key names are used with and without a leading / (e.g. /scripts/mapper.py
+# is uploaded and s3n://bucket/scripts/mapper.py run), as the same key
+def normalize_key_name(name):
+    return name.lstrip("/")
+
+
+class FakeKey(object):
+
+    def __init__(self, bucket, name, upload_bandwidth=0):
+        self.bucket = bucket
+        name = normalize_key_name(name)
+        self.name = name
+        self.key = name
+        self.upload_bandwidth = upload_bandwidth
+        self.content = b""
+        self.position = 0
+
+    @property
+    def etag(self):
+        return '"' + hashlib.md5(self.content).hexdigest() + '"'
+
+    @property
+    def size(self):
+        return len(self.content)
+
+    def set_contents_from_string(self, content, *args, **kwargs):
+        if not isinstance(content, bytes):
+            content = content.encode("utf-8")
+        # models the transfer time when a bandwidth (bytes/s) is given
+        if self.upload_bandwidth:
+            time.sleep(len(content) / float(self.upload_bandwidth))
+        self.content = content
+        # multipart uploads (see FakeBucket) send their parts here too
+        query = dict(argument.split("=", 1) for argument in kwargs.get("query_args", "").split("&") if argument)
+        if "partNumber" in query:
+            self.bucket.parts.setdefault(query["uploadId"], {})[int(query["partNumber"])] = content
+        else:
+            self.bucket.objects[self.name] = self
+
+    def set_contents_from_file(self, file_object, *args, **kwargs):
+        self.set_contents_from_string(file_object.read(), **kwargs)
+
+    def set_contents_from_filename(self, filename, cb=None, num_cb=None, **kwargs):
+        with open(filename, "rb") as source:
+            self.set_contents_from_string(source.read())
+        if cb:
+            cb(self.size, self.size)
+
+    def get_contents_as_string(self):
+        return self.content
+
+    def read(self, size=-1):
+        end = len(self.content) if size < 0 else self.position + size
+        data = self.content[self.position:end]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.position = 0
+
+
+class FakeBucket(object):
+
+    def __init__(self, name, upload_bandwidth=0, request_latency=0):
+        self.name = name
+        self.upload_bandwidth = upload_bandwidth
+        self.request_latency = request_latency
+        self.objects = {}
+        self.parts = {}
+
+    def new_key(self, key_name):
+        return FakeKey(self, key_name, self.upload_bandwidth)
+
+    # a copy, so readers in different threads don't share the read position
+    def get_key(self, name):
+        time.sleep(self.request_latency)
+        key = self.objects.get(normalize_key_name(name))
+        if key is None:
+            return None
+        copy = FakeKey(self, name, self.upload_bandwidth)
+        copy.content = key.content
+        return copy
+
+    def list(self, prefix=""):
+        time.sleep(self.request_latency)
+        return [self.objects[name] for name in sorted(self.objects) if name.startswith(normalize_key_name(prefix))]
+
+    def get_all_keys(self):
+        return self.list()
+
+    def delete_keys(self, key_names):
+        for name in key_names:
+            self.objects.pop(normalize_key_name(name), None)
+
+    # Multipart uploads keep their parts in this bucket object only, so a key
+    # completed in another process (e.g. by another s3-parallel-put putter)
+    # only gets the parts uploaded through this one
+    def initiate_multipart_upload(self, key_name, headers=None, policy=None, **kwargs):
+        upload_id = hashlib.md5(("%s %s %s" % (self.name, key_name, time.time())).encode("utf-8")).hexdigest()
+        self.parts[upload_id] = {}
+        return FakeObject(id=upload_id, key_name=key_name)
+
+    def complete_multipart_upload(self, key_name, upload_id, xml_body, headers=None):
+        parts = self.parts.pop(upload_id, {})
+        key = FakeKey(self, key_name)
+        key.content = b"".join(parts[number] for number in sorted(parts))
+        self.objects[key.name] = key
+        return key
+
+    def cancel_multipart_upload(self, key_name, upload_id, headers=None):
+        self.parts.pop(upload_id, None)
+
+
+# Replaces S3Connection. Buckets are created on demand. Listing and getting
+# keys take request_latency seconds, like a round trip to S3.
+class FakeS3Connection(object):
+
+    def __init__(self, upload_bandwidth=0, request_latency=0):
+        self.upload_bandwidth = upload_bandwidth
+        self.request_latency = request_latency
+        self.buckets = {}
+
+    def create_bucket(self, bucket_name, location=None):
+        return self.get_bucket(bucket_name)
+
+    def get_bucket(self, bucket_name, validate=True):
+        if bucket_name not in self.buckets:
+            self.buckets[bucket_name] = FakeBucket(bucket_name, self.upload_bandwidth, self.request_latency)
+        return self.buckets[bucket_name]
+
+    def delete_bucket(self, bucket_name):
+        self.buckets.pop(bucket_name, None)
+
+
+# Replaces EmrConnection. Clusters become WAITING after cluster_latency
+# seconds and run their steps one after the other, each one taking
+# step_latencies[step name] (or step_latency) seconds. on_step_completed is
+# called with the step once it finishes, e.g. to write its output to S3.
+#
+# Every cluster and step records when it finished and when the caller first
+# saw it finished, so the time lost between polls can be measured. Instance
+# groups can be listed, added and resized; resizes apply immediately.
+#
+# With an s3_connection, a cluster FAILS when the script of a bootstrap
+# action or one of its s3:// arguments is not in the fake S3, as the real
+# bootstrap action would.
+class FakeEmrConnection(object):
+
+    def __init__(self, cluster_latency=1.0, step_latency=1.0, step_latencies=None, on_step_completed=None, s3_connection=None):
+        self.cluster_latency = cluster_latency
+        self.step_latency = step_latency
+        self.step_latencies = step_latencies or {}
+        self.on_step_completed = on_step_completed
+        self.s3_connection = s3_connection
+        self.clusters = {}
+        self.lock = threading.RLock()
+
+    def run_jobflow(self, name, log_uri=None, **kwargs):
+        with self.lock:
+            cluster_id = "j-FAKE%d" % (len(self.clusters) + 1)
+            now = time.time()
+            cluster = FakeObject(id=cluster_id, name=name, log_uri=log_uri, kwargs=kwargs,
+                                 launched_at=now, ready_at=now + self.cluster_latency,
+                                 detected_at=None, terminated=False, steps=[], instance_groups=[],
+                                 bootstrap_failed=self._bootstrap_fails(kwargs.get("bootstrap_actions") or []))
+            self.clusters[cluster_id] = cluster
+            instance_groups = kwargs.get("instance_groups")
+            if not instance_groups:
+                # legacy launch: one master and num_instances - 1 core nodes
+                instance_groups = [FakeObject(num_instances=1, role="MASTER", type=kwargs.get("master_instance_type"), market="ON_DEMAND", bidprice=None),
+                                   FakeObject(num_instances=kwargs.get("num_instances", 1) - 1, role="CORE", type=kwargs.get("slave_instance_type"), market="ON_DEMAND", bidprice=None)]
+            self._add_groups(cluster, instance_groups)
+            return cluster_id
+
+    def describe_jobflow(self, cluster_id):
+        with self.lock:
+            cluster = self.clusters[cluster_id]
+            now = time.time()
+            if cluster.terminated:
+                state = u"TERMINATED"
+            elif now < cluster.ready_at:
+                state = u"STARTING"
+            elif cluster.bootstrap_failed:
+                state = u"FAILED"
+            else:
+                state = u"RUNNING" if self._running_step(cluster, now) else u"WAITING"
+                if cluster.detected_at is None:
+                    cluster.detected_at = now
+            return FakeObject(jobflowid=cluster_id, state=state, masterpublicdnsname="master." + cluster_id + ".fake")
+
+    def add_jobflow_steps(self, cluster_id, steps):
+        with self.lock:
+            cluster = self.clusters[cluster_id]
+            step_ids = []
+            for step in steps:
+                start = max([time.time(), cluster.ready_at] + [fake.finished_at for fake in cluster.steps])
+                latency = self.step_latencies.get(step.name, self.step_latency)
+                fake = FakeObject(id="s-FAKE%d" % (sum(len(c.steps) for c in self.clusters.values()) + 1),
+                                  step=step, submitted_at=time.time(), started_at=start,
+                                  finished_at=start + latency, detected_at=None, notified=False)
+                cluster.steps.append(fake)
+                step_ids.append(FakeObject(value=fake.id))
+            return FakeObject(stepids=step_ids)
+
+    def list_steps(self, cluster_id, *args, **kwargs):
+        with self.lock:
+            cluster = self.clusters[cluster_id]
+            now = time.time()
+            summaries = []
+            for fake in cluster.steps:
+                if now >= fake.finished_at:
+                    state = u"COMPLETED"
+                    self._complete(fake, now)
+                elif now >= fake.started_at:
+                    state = u"RUNNING"
+                else:
+                    state = u"PENDING"
+                summaries.append(FakeObject(id=fake.id, name=fake.step.name, status=FakeObject(state=state)))
+            return FakeObject(steps=list(reversed(summaries)))
+
+    def list_instance_groups(self, cluster_id, marker=None):
+        with self.lock:
+            return FakeObject(instancegroups=list(self.clusters[cluster_id].instance_groups))
+
+    def add_instance_groups(self, cluster_id, instance_groups):
+        with self.lock:
+            group_ids = self._add_groups(self.clusters[cluster_id], instance_groups)
+            return FakeObject(jobflowid=cluster_id, instancegroupids=",".join(group_ids))
+
+    def modify_instance_groups(self, instance_group_ids, new_sizes):
+        with self.lock:
+            sizes = dict(zip(instance_group_ids, new_sizes))
+            for cluster in self.clusters.values():
+                for group in cluster.instance_groups:
+                    if group.id in sizes:
+                        group.requestedinstancecount = group.runninginstancecount = sizes[group.id]
+
+    def terminate_jobflow(self, cluster_id):
+        with self.lock:
+            self.clusters[cluster_id].terminated = True
+
+    # Seconds between a cluster or step finishing and the caller noticing it
+    def poll_waste(self):
+        waste = 0.0
+        for cluster in self.clusters.values():
+            if cluster.detected_at:
+                waste += cluster.detected_at - cluster.ready_at
+            for fake in cluster.steps:
+                if fake.detected_at:
+                    waste += fake.detected_at - fake.finished_at
+        return waste
+
+    # Seconds the simulated services spent provisioning clusters and running steps
+    def service_time(self):
+        busy = 0.0
+        for cluster in self.clusters.values():
+            busy += cluster.ready_at - cluster.launched_at
+            busy += sum(fake.finished_at - fake.started_at for fake in cluster.steps)
+        return busy
+
+    def _add_groups(self, cluster, instance_groups):
+        group_ids = []
+        for group in instance_groups:
+            group_id = "ig-FAKE%d" % (sum(len(c.instance_groups) for c in self.clusters.values()) + 1)
+            cluster.instance_groups.append(FakeObject(id=group_id, instancegrouptype=group.role, instancetype=group.type,
+                                                      market=group.market, bidprice=getattr(group, "bidprice", None),
+                                                      requestedinstancecount=group.num_instances,
+                                                      runninginstancecount=group.num_instances))
+            group_ids.append(group_id)
+        return group_ids
+
+    def _bootstrap_fails(self, bootstrap_actions):
+        if self.s3_connection is None:
+            return False
+        for action in bootstrap_actions:
+            for path in [action.path] + list(action.bootstrap_action_args):
+                if path.startswith("s3"):
+                    bucket_name, key_name = split_s3_path(path)
+                    if self.s3_connection.get_bucket(bucket_name).get_key(key_name) is None:
+                        return True
+        return False
+
+    def _running_step(self, cluster, now):
+        return any(fake.started_at <= now < fake.finished_at for fake in cluster.steps)
+
+    def _complete(self, fake, now):
+        if fake.detected_at is None:
+            fake.detected_at = now
+        if not fake.notified:
+            fake.notified = True
+            if self.on_step_completed:
+                self.on_step_completed(fake.step)
+
+
+# DbConnection to a local PostgreSQL standing in for Redshift. Redshift's
+# COPY ... FROM 's3://...' is translated into COPY ... FROM STDIN fed from
+# the fake S3 objects under the same prefix, and the SORTKEY of CREATE TABLE
+# into an index on the same columns.
+class LocalRedshiftConnection(DbConnection):
+
+    copy_re = re.compile(r"^\s*COPY\s+(\S+)\s+FROM\s+'(s3n?://[^']+)'.*?DELIMITER\s+'([^']+)'", re.IGNORECASE | re.DOTALL)
+    sortkey_re = re.compile(r"^\s*CREATE\s+TABLE\s+(\S+)(.*)\s+SORTKEY\s*\(([^)]*)\)\s*$", re.IGNORECASE | re.DOTALL)
+
+    def __init__(self, parameters, s3_connection):
+        DbConnection.__init__(self, parameters)
+        self.s3_connection = s3_connection
+
+    def execute(self, statement):
+        sortkey = self.sortkey_re.match(statement)
+        if sortkey:
+            table_name, definition, columns = sortkey.groups()
+            DbConnection.execute(self, "CREATE TABLE " + table_name + definition)
+            return DbConnection.execute(self, "CREATE INDEX ON " + table_name + " (" + columns + ")")
+        match = self.copy_re.match(statement)
+        if not match:
+            return DbConnection.execute(self, statement)
+        table_name, source, delimiter = match.groups()
+        bucket_name, prefix = split_s3_path(source)
+        with timeline.span("sql.execute", statement="COPY " + table_name.upper()) as span:
+            rows = 0
+            for key in self.s3_connection.get_bucket(bucket_name).list(prefix):
+                self.cursor.copy_expert("COPY " + table_name + " FROM STDIN WITH DELIMITER '" + delimiter + "'", io.BytesIO(key.content))
+                rows += self.cursor.rowcount
+            span.set("rows", rows)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Checks instance group launches and task group resizes against the fake
+# EmrConnection: the cluster is launched with on-demand master/core groups
+# and a spot task group, which is grown before a heavy step and shrunk
+# afterwards. A second cluster without task group gets one added on grow.
+#
+# usage: python -m benchmark.instance_groups
+
+import logging
+import os
+import sys
+
+root_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, root_folder)
+
+import defaults
+import orchestrator
+from benchmark import pipeline
+
+
+def task_groups(emr_connection):
+    groups = emr_connection.list_instance_groups(defaults.cluster_id).instancegroups
+    return [group for group in groups if group.instancegrouptype == "TASK"]
+
+
+def main(argv):
+    logging.getLogger().setLevel(logging.WARNING)
+    emr_connection = pipeline.prepare(pipeline.fake_options())
+    defaults.use_instance_groups = True
+    defaults.task_instances = 2
+    defaults.task_instances_heavy = 8
+    defaults.task_bid_price = "0.10"
+    results = []
+
+    orchestrator.run(["launch_emr"])
+    groups = emr_connection.list_instance_groups(defaults.cluster_id).instancegroups
+    roles = dict((group.instancegrouptype, group) for group in groups)
+    results.append(pipeline.check("master and core groups are on-demand",
+                         roles["MASTER"].market == "ON_DEMAND" and roles["CORE"].market == "ON_DEMAND"))
+    results.append(pipeline.check("core group has num_instances - 1 nodes",
+                         roles["CORE"].requestedinstancecount == defaults.num_instances - 1))
+    results.append(pipeline.check("task group runs on spot with the bid price",
+                         roles["TASK"].market == "SPOT" and roles["TASK"].bidprice == defaults.task_bid_price))
+    orchestrator.run(["grow_task_group"])
+    results.append(pipeline.check("grow_task_group resizes it to task_instances_heavy",
+                         task_groups(emr_connection)[0].requestedinstancecount == defaults.task_instances_heavy))
+    orchestrator.run(["shrink_task_group"])
+    results.append(pipeline.check("shrink_task_group resizes it back to task_instances",
+                         task_groups(emr_connection)[0].requestedinstancecount == defaults.task_instances))
+
+    defaults.task_instances = 0
+    orchestrator.run(["launch_emr"])
+    results.append(pipeline.check("no task group is launched when task_instances is 0", not task_groups(emr_connection)))
+    orchestrator.run(["grow_task_group"])
+    groups = task_groups(emr_connection)
+    results.append(pipeline.check("grow_task_group adds a spot task group",
+                         len(groups) == 1 and groups[0].market == "SPOT" and groups[0].requestedinstancecount == defaults.task_instances_heavy))
+
+    defaults.use_instance_groups = False
+    orchestrator.run(["launch_emr"])
+    results.append(pipeline.check("legacy launch still uses master/slave types",
+                         "instance_groups" not in emr_connection.clusters[defaults.cluster_id].kwargs or
+                         not emr_connection.clusters[defaults.cluster_id].kwargs["instance_groups"]))
+
+    # artifacts staged by the bootstrap action
+    s3_bucket = orchestrator.registry.get("s3").connection.get_bucket(defaults.bucket_name)
+    defaults.step_type = "jar"
+    orchestrator.run(["launch_emr"])
+    results.append(pipeline.check("jar steps launch without bootstrap action",
+                         not emr_connection.clusters[defaults.cluster_id].kwargs["bootstrap_actions"]))
+    defaults.step_type = "streaming"
+    defaults.cluster_id = None
+    orchestrator.run(["launch_emr"])
+    results.append(pipeline.check("launch is refused while the mapper to stage is missing", defaults.cluster_id is None))
+    orchestrator.run(["upload_mapper", "launch_emr"])
+    results.append(pipeline.check("launch uploads the stage script and the bootstrap succeeds",
+                         s3_bucket.get_key(defaults.scripts_remote_path[1:] + defaults.step_stage_artifacts_script) is not None and
+                         not orchestrator._failed(defaults.cluster_id) and
+                         emr_connection.describe_jobflow(defaults.cluster_id).state == u"WAITING"))
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
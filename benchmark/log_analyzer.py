@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# Checks the step reports of aws/log_analyzer.py against a synthetic EMR log
+# tree in the fake S3: a step syslog, gzipped task attempt syslogs (plus the
+# application master's) and a job history file, with a few maps made slow on
+# purpose and a failed attempt. It then times the analysis with one worker
+# and with log_analyzer_workers, every S3 request taking --request-latency
+# seconds, and runs it through the orchestrator, both as the report_step
+# action and after a mapreduce step when report_after_mapreduce is set.
+#
+# usage: python -m benchmark.log_analyzer [options]
+
+import gzip
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+root_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, root_folder)
+
+import defaults
+import orchestrator
+from benchmark import pipeline
+from timeline import timeline
+
+cluster_id = "j-LOGS"
+step_id = "s-LOGS"
+job_id = "1413452143_0001"
+started = 1413452400.0
+
+
+def gzipped(text):
+    data = io.BytesIO()
+    with gzip.GzipFile(fileobj=data, mode="wb") as gzip_file:
+        gzip_file.write(text.encode("utf-8"))
+    return data.getvalue()
+
+
+def log_time(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(seconds)) + ",%03d" % (int(seconds * 1000) % 1000)
+
+
+def history_event(kind, record, fields):
+    return json.dumps({"type": kind, "event": {"org.apache.hadoop.mapreduce.jobhistory." + record: fields}})
+
+
+def counters(input_bytes):
+    return {"name": "COUNTERS", "groups": [
+        {"name": "org.apache.hadoop.mapreduce.lib.input.FileInputFormatCounter", "displayName": "File Input Format Counters",
+         "counts": [{"name": "BYTES_READ", "displayName": "Bytes Read", "value": input_bytes}]}]}
+
+
+# Task attempt syslog: setup, then the map, padded with progress lines, then the output commit
+def task_syslog(attempt_id, start, setup, process, commit, split_bytes, padding):
+    lines = [log_time(start) + " INFO [main] org.apache.hadoop.metrics2.impl.MetricsSystemImpl: MapTask metrics system started"]
+    processing = start + setup
+    lines.append(log_time(processing) + " INFO [main] org.apache.hadoop.mapred.MapTask: Processing split: s3n://" +
+                 defaults.bucket_name + "/input/SuppliersMonitor.log:0+%d" % split_bytes)
+    for line in range(padding):
+        lines.append(log_time(processing + process * line / padding) + " INFO [main] org.apache.hadoop.mapred.MapTask: Spilling map output, kvstart = %d" % line)
+    committing = processing + process
+    lines.append(log_time(committing) + " INFO [main] org.apache.hadoop.mapred.Task: Task:" + attempt_id + " is done. And is in the process of committing")
+    lines.append(log_time(committing + commit) + " INFO [main] org.apache.hadoop.mapred.Task: Task '" + attempt_id + "' done.")
+    return "\n".join(lines) + "\n"
+
+
+# Writes the logs of a step with maps map tasks, the last stragglers of them
+# slow. Returns what the report must say
+def write_logs(bucket, maps, stragglers, padding):
+    random.seed(42)
+    prefix = defaults.log_dir.strip("/") + "/" + cluster_id + "/"
+    bucket.new_key(prefix + "steps/" + step_id + "/syslog").set_contents_from_string(
+        log_time(started) + " INFO org.apache.hadoop.mapreduce.Job (main): Running job: job_" + job_id + "\n" +
+        log_time(started + 300) + " INFO org.apache.hadoop.mapreduce.Job (main): Job job_" + job_id + " completed successfully\n")
+    application = "task-attempts/application_" + job_id + "/"
+    bucket.new_key(prefix + application + "container_" + job_id + "_01_000001/syslog.gz").set_contents_from_string(gzipped(
+        log_time(started) + " INFO [main] org.apache.hadoop.mapreduce.v2.app.MRAppMaster: Created MRAppMaster for application appattempt_" + job_id + "_000001\n"))
+    events = [history_event("JOB_SUBMITTED", "JobSubmitted", {"jobid": "job_" + job_id, "jobName": "streamjob", "submitTime": int(started * 1000)}),
+              history_event("JOB_INITED", "JobInited", {"jobid": "job_" + job_id, "launchTime": int((started + 5) * 1000)})]
+    expected = {"stragglers": set(), "split_bytes": [], "phases": {"setup": 0.0, "process": 0.0, "commit": 0.0}}
+    container = 2
+    for task in range(maps):
+        split_bytes = random.randint(60, 68) * 1024 * 1024
+        setup, process, commit = random.uniform(2, 4), random.uniform(50, 60), random.uniform(1, 2)
+        if task >= maps - stragglers:
+            process *= 3
+            commit *= 10
+        attempts = ["failed", "succeeded"] if task == 0 else ["succeeded"]
+        start = started + 10 + task
+        for number, outcome in enumerate(attempts):
+            attempt_id = "attempt_%s_m_%06d_%d" % (job_id, task, number)
+            task_id = "task_%s_m_%06d" % (job_id, task)
+            events.append(history_event("MAP_ATTEMPT_STARTED", "TaskAttemptStarted",
+                                        {"taskid": task_id, "taskType": "MAP", "attemptId": attempt_id, "startTime": int(start * 1000)}))
+            if outcome == "failed":
+                events.append(history_event("MAP_ATTEMPT_FAILED", "TaskAttemptUnsuccessfulCompletion",
+                                            {"taskid": task_id, "taskType": "MAP", "attemptId": attempt_id, "finishTime": int((start + 20) * 1000),
+                                             "hostname": "ip-10-0-0-%d" % (task % 8), "status": "FAILED", "error": "Java heap space"}))
+                start += 25
+                continue
+            # the container starts a little after the history records the attempt start
+            text = task_syslog(attempt_id, start + 0.5, setup, process, commit, split_bytes, padding)
+            bucket.new_key(prefix + application + "container_%s_01_%06d/syslog.gz" % (job_id, container)).set_contents_from_string(gzipped(text))
+            container += 1
+            finish = start + 0.5 + setup + process + commit
+            events.append(history_event("MAP_ATTEMPT_FINISHED", "MapAttemptFinished",
+                                        {"taskid": task_id, "taskType": "MAP", "attemptId": attempt_id, "taskStatus": "SUCCEEDED",
+                                         "mapFinishTime": int((finish - commit) * 1000), "finishTime": int(finish * 1000),
+                                         "hostname": {"string": "ip-10-0-0-%d" % (task % 8)}, "counters": counters(split_bytes)}))
+            if task >= maps - stragglers:
+                expected["stragglers"].add(attempt_id)
+            expected["split_bytes"].append(split_bytes)
+            # setup is timed from the attempt start in the job history
+            expected["phases"]["setup"] += setup + 0.5
+            expected["phases"]["process"] += process
+            expected["phases"]["commit"] += commit
+    events.append(history_event("JOB_FINISHED", "JobFinished", {"jobid": "job_" + job_id, "finishTime": int((started + 300) * 1000),
+                                                                "finishedMaps": maps, "finishedReduces": 0, "failedMaps": 1}))
+    history = "Avro-Json\n{\"type\":\"record\",\"name\":\"Event\"}\n\n" + "\n".join(events) + "\n"
+    bucket.new_key(prefix + "hadoop-mapreduce/history/2014/10/16/000000/job_" + job_id + "-1413452400000-hadoop-streamjob-1413452700000-" +
+                   str(maps) + "-0-SUCCEEDED-default.jhist").set_contents_from_string(history)
+    return expected
+
+
+def close(first, second):
+    return abs(first - second) < 0.01 * max(abs(first), abs(second), 1.0)
+
+
+def analyze(workers):
+    orchestrator.log_analyzer_parameters["workers"] = workers
+    orchestrator.registry.reset()
+    start = time.time()
+    report = orchestrator.registry.get("log_analyzer").analyze_step(cluster_id, step_id)
+    return report, time.time() - start
+
+
+def main(argv):
+    parser = OptionParser(usage="python -m benchmark.log_analyzer [options]")
+    parser.add_option("--maps", default=60, type=int, help="map tasks of the synthetic step")
+    parser.add_option("--stragglers", default=3, type=int, help="slow map tasks")
+    parser.add_option("--padding", default=2000, type=int, help="progress lines in each task attempt log")
+    parser.add_option("--request-latency", default=0.05, type=float, help="seconds each fake S3 list or get takes")
+    options, arguments = parser.parse_args(argv[1:])
+    logging.getLogger().setLevel(logging.WARNING)
+    pipeline.prepare(pipeline.fake_options())
+    s3_connection = orchestrator.registry.get("s3").connection
+    expected = write_logs(s3_connection.get_bucket(defaults.bucket_name), options.maps, options.stragglers, options.padding)
+    s3_connection.request_latency = options.request_latency
+    s3_connection.get_bucket(defaults.bucket_name).request_latency = options.request_latency
+    results = []
+
+    report, serial = analyze(1)
+    summary = report["summary"]
+    results.append(pipeline.check("job found from the step syslog", report["job_ids"] == ["job_" + job_id]))
+    results.append(pipeline.check("every successful map is counted", summary["maps"] == options.maps))
+    results.append(pipeline.check("the failed attempt is counted", summary["failed_attempts"] == 1))
+    results.append(pipeline.check("no logs are reported missing", not report["logs"]["missing"]))
+    results.append(pipeline.check("stragglers are the slow maps", set(attempt["attempt_id"] for attempt in report["stragglers"]) == expected["stragglers"]))
+    results.append(pipeline.check("split sizes come from the task logs",
+                         summary["split_bytes"]["min"] == min(expected["split_bytes"]) and summary["split_bytes"]["max"] == max(expected["split_bytes"])))
+    results.append(pipeline.check("setup, map and output commit times add up",
+                         all(close(summary["map_phases"][phase], expected["phases"][phase]) for phase in expected["phases"])))
+    results.append(pipeline.check("hosts come from the job history", all(attempt.get("host") for attempt in report["attempts"])))
+
+    parallel_report, parallel = analyze(defaults.log_analyzer_workers)
+    results.append(pipeline.check("parallel analysis gives the same report",
+                         json.dumps(dict(parallel_report, logs=None), sort_keys=True) == json.dumps(dict(report, logs=None), sort_keys=True)))
+    print("%d files, %.1f MB: 1 worker %.3fs, %d workers %.3fs (%.1fx)" % (
+        report["logs"]["files"], report["logs"]["bytes"] / 1024.0 / 1024.0, serial, defaults.log_analyzer_workers, parallel, serial / parallel))
+    for line in orchestrator.registry.get("log_analyzer").format_report(parallel_report):
+        print("  " + line)
+
+    folder = tempfile.mkdtemp(prefix="log_analyzer-")
+    try:
+        defaults.step_reports_path = os.path.join(folder, "reports")
+        orchestrator.run(["report_step"])
+        results.append(pipeline.check("report_step without a mapreduce step does nothing", not os.path.exists(defaults.step_reports_path)))
+        # as if the step had been run by an earlier invocation
+        orchestrator.registry.get("result_cache").put("logs", defaults.output_remote_path + "logs/", {}, cluster_id, step_id)
+        orchestrator.run(["report_step"])
+        with open(os.path.join(defaults.step_reports_path, step_id + ".json")) as report_file:
+            saved = json.load(report_file)
+        results.append(pipeline.check("report_step reports the step of the last cached result", saved["summary"]["maps"] == options.maps))
+        # the fake cluster pushes no logs, so reports after a step wait for them and then list them as missing
+        s3_connection.request_latency = s3_connection.get_bucket(defaults.bucket_name).request_latency = 0
+        defaults.step_report_wait = 0.3
+        orchestrator.run(["upload_mapper", "launch_emr", "mapreduce"])
+        results.append(pipeline.check("mapreduce reports its step only when asked to",
+                                       not os.path.exists(os.path.join(defaults.step_reports_path, defaults.step_id + ".json"))))
+        defaults.report_after_mapreduce = True
+        orchestrator.run(["clear_result_cache", "mapreduce"])
+        step_report = os.path.join(defaults.step_reports_path, defaults.step_id + ".json")
+        results.append(pipeline.check("mapreduce writes the report of its step", os.path.exists(step_report)))
+        results.append(pipeline.check("waiting for its logs is bounded",
+                             len(timeline.find("logs.analyze_step")) > 1 and os.path.exists(step_report) and json.load(open(step_report))["logs"]["missing"]))
+        # a file where the reports folder should be
+        defaults.step_reports_path = step_report
+        orchestrator.run(["clear_result_cache", "mapreduce", "terminate_emr"])
+        results.append(pipeline.check("a report that can't be written doesn't stop the run",
+                                      orchestrator.registry.get("result_cache").latest()["step_id"] == defaults.step_id and
+                                      orchestrator.registry.get("emr").connection.clusters[defaults.cluster_id].terminated))
+    finally:
+        shutil.rmtree(folder)
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
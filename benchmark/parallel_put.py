@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# Offline benchmark of aws/s3-parallel-put.py.
+#
+# S3Connection is replaced by the fake in benchmark/fakes.py, then the script
+# uploads a synthetic set of log files from an uncompressed, a gzipped and a
+# bzip2'd tarball, and from a skewed directory tree: the same files plus one
+# large file in a subdirectory, which a plain directory walk queues last.
+# Every source runs in a fresh interpreter, which reports its wall time and
+# the peak memory of the walker process (which holds whatever content is
+# waiting in the put queue).
+#
+# Uploads only take time with --upload-bandwidth, which is what makes the
+# order of the skewed tree matter.
+#
+# Every uploaded object, including the large file assembled from parts
+# uploaded by different putters, must equal its source file. The skewed
+# tree is then uploaded again with a part of the large file failing, which
+# must leave no multipart upload behind.
+#
+# usage: python -m benchmark.parallel_put [options] [source ...]
+# sources: tar tar.gz tar.bz2 tree (default: all of them)
+
+import imp
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import urllib
+from optparse import OptionParser
+
+root_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, root_folder)
+
+from boto.exception import S3ResponseError
+from benchmark.fakes import FakeBucket, FakeKey, FakeS3Connection, normalize_key_name
+
+default_script = os.path.join(root_folder, "aws", "s3-parallel-put.py")
+default_sources = ["tar", "tar.gz", "tar.bz2", "tree"]
+
+
+# Writes count availability-like log files of about size bytes each
+def write_files(folder, count, size):
+    random.seed(42)
+    for number in range(count):
+        lines = []
+        written = 0
+        while written < size:
+            line = "%02d/05/2014 10:%02d:00|%d|AVA|1|%s|2|%02d/06/2014|3|4|5|6|7|8|%d|END\n" % (
+                random.randint(1, 28), random.randint(0, 59), random.randint(0, 99999),
+                random.choice(["PMI", "BCN", "MAD", "PMI#TFS"]), random.randint(1, 28), random.randint(0, 500))
+            lines.append(line)
+            written += len(line)
+        with open(os.path.join(folder, "log-%05d.txt" % number), "w") as log_file:
+            log_file.write("".join(lines))
+
+
+# Writes a file of size bytes made of copies of an existing log file
+def write_large_file(path, size, source_path):
+    with open(source_path) as source_file:
+        block = source_file.read()
+    with open(path, "w") as large_file:
+        for written in range(0, size, len(block)):
+            large_file.write(block[:size - written])
+
+
+def write_tarballs(folder, files_folder):
+    tarballs = {}
+    for source, mode in (("tar", "w"), ("tar.gz", "w:gz"), ("tar.bz2", "w:bz2")):
+        tarballs[source] = os.path.join(folder, "logs." + source)
+        with tarfile.open(tarballs[source], mode) as tar_file:
+            tar_file.add(files_folder, arcname="logs")
+    return tarballs
+
+
+def object_path(store, key_name):
+    return os.path.join(store, "objects", urllib.quote(normalize_key_name(key_name), safe=""))
+
+
+# Fake key of SharedBucket. Uploading part failing_part of a multipart upload
+# fails, like S3 returning an error
+class SharedKey(FakeKey):
+
+    def set_contents_from_string(self, content, *args, **kwargs):
+        query = dict(argument.split("=", 1) for argument in kwargs.get("query_args", "").split("&") if argument)
+        if "partNumber" in query and int(query["partNumber"]) == self.bucket.failing_part:
+            raise S3ResponseError(500, "Internal Error")
+        FakeKey.set_contents_from_string(self, content, *args, **kwargs)
+        if "partNumber" in query:
+            path = os.path.join(self.bucket.store, "parts", query["uploadId"], query["partNumber"])
+        else:
+            path = object_path(self.bucket.store, self.name)
+        with open(path, "wb") as stored_file:
+            stored_file.write(self.content)
+
+
+# Fake bucket whose objects and multipart parts are also files in the store
+# folder, shared by the processes of the script, so the objects it assembles
+# from parts uploaded by different putters can be checked
+class SharedBucket(FakeBucket):
+
+    def __init__(self, name, upload_bandwidth, store, failing_part):
+        FakeBucket.__init__(self, name, upload_bandwidth)
+        self.store = store
+        self.failing_part = failing_part
+
+    def new_key(self, key_name):
+        return SharedKey(self, key_name, self.upload_bandwidth)
+
+    def initiate_multipart_upload(self, key_name, headers=None, policy=None, **kwargs):
+        upload = FakeBucket.initiate_multipart_upload(self, key_name, headers, policy, **kwargs)
+        os.mkdir(os.path.join(self.store, "parts", upload.id))
+        return upload
+
+    # Like S3, only the parts listed are assembled, and they must all have been uploaded
+    def complete_multipart_upload(self, key_name, upload_id, xml_body, headers=None):
+        self.parts.pop(upload_id, None)
+        parts_folder = os.path.join(self.store, "parts", upload_id)
+        key = self.new_key(key_name)
+        for part_number in re.findall(r"<PartNumber>(\d+)</PartNumber>", xml_body):
+            with open(os.path.join(parts_folder, part_number), "rb") as part_file:
+                key.content += part_file.read()
+        with open(object_path(self.store, key_name), "wb") as stored_file:
+            stored_file.write(key.content)
+        shutil.rmtree(parts_folder)
+        self.objects[key.name] = key
+        return key
+
+    def cancel_multipart_upload(self, key_name, upload_id, headers=None):
+        FakeBucket.cancel_multipart_upload(self, key_name, upload_id, headers)
+        shutil.rmtree(os.path.join(self.store, "parts", upload_id))
+
+
+# Runs the script once on a source and prints its timings as json (child process)
+def measure(script_path, arguments, upload_bandwidth, store, failing_part):
+    script = imp.load_source("s3_parallel_put", script_path)
+
+    def connection(**kwargs):
+        s3_connection = FakeS3Connection(upload_bandwidth)
+        s3_connection.buckets["benchmark"] = SharedBucket("benchmark", upload_bandwidth, store, failing_part)
+        return s3_connection
+    script.S3Connection = connection
+    walker = script.walker
+    walker_memory = multiprocessing.Value("l", 0)
+
+    # the walker runs in its own process; ru_maxrss is in kilobytes on Linux
+    def measured_walker(*args):
+        walker(*args)
+        walker_memory.value = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    script.walker = measured_walker
+    start = time.time()
+    status = script.main([script_path, "--bucket", "benchmark", "--quiet"] + arguments)
+    wall = time.time() - start
+    print(json.dumps({"status": status, "wall": wall, "walker_memory": walker_memory.value}))
+
+
+# Runs the script on a source in a fresh interpreter, with a fresh store
+def run(options, arguments, store, failing_part=0):
+    shutil.rmtree(store, ignore_errors=True)
+    os.makedirs(os.path.join(store, "objects"))
+    os.mkdir(os.path.join(store, "parts"))
+    output = subprocess.check_output([sys.executable, "-m", "benchmark.parallel_put", "--child", options.script,
+                                      str(options.upload_bandwidth), json.dumps(arguments), store, str(failing_part)], cwd=root_folder)
+    return json.loads(output.splitlines()[-1])
+
+
+# Key names of the files of a source, with their paths
+def source_files(source, files_folder):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(files_folder):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if source == "tree":
+                files[path] = path
+            elif os.path.dirname(path) == files_folder:
+                files["logs/" + filename] = path
+    return files
+
+
+# Source files whose object is missing or differs
+def differing_objects(store, files):
+    differing = []
+    for key_name, path in sorted(files.items()):
+        if not os.path.exists(object_path(store, key_name)):
+            differing.append(path)
+            continue
+        with open(object_path(store, key_name), "rb") as stored_file, open(path, "rb") as source_file:
+            if stored_file.read() != source_file.read():
+                differing.append(path)
+    return differing
+
+
+def report(label, result, total_size):
+    print("%-8s wall %8.3fs  %10.0f bytes/s  walker peak memory %8.1f MB" % (
+        label, result["wall"], total_size / result["wall"], result["walker_memory"] / 1024.0 / 1024.0))
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == "--child":
+        measure(argv[2], json.loads(argv[4]), int(argv[3]), argv[5], int(argv[6]))
+        return 0
+    parser = OptionParser(usage="python -m benchmark.parallel_put [options] [source ...]")
+    parser.add_option("--files", default=200, type=int, help="number of files")
+    parser.add_option("--file-size", default=256 * 1024, type=int, help="size of each file in bytes")
+    parser.add_option("--large-file-size", default=128 * 1024 * 1024, type=int, help="size of the large file of the skewed tree in bytes")
+    parser.add_option("--processes", default=8, type=int, help="putter processes")
+    parser.add_option("--upload-bandwidth", default=0, type=int, help="fake S3 upload bandwidth per putter in bytes/s (0: unlimited)")
+    parser.add_option("--script", default=default_script, metavar="FILENAME", help="s3-parallel-put.py to run, e.g. an older version to compare with")
+    options, sources = parser.parse_args(argv[1:])
+    sources = sources or default_sources
+    folder = tempfile.mkdtemp(prefix="parallel_put-")
+    store = os.path.join(folder, "store")
+    try:
+        files_folder = os.path.join(folder, "logs")
+        os.mkdir(files_folder)
+        write_files(files_folder, options.files, options.file_size)
+        total_size = sum(os.path.getsize(os.path.join(files_folder, name)) for name in os.listdir(files_folder))
+        tarballs = write_tarballs(folder, files_folder)
+        if "tree" in sources:
+            os.mkdir(os.path.join(files_folder, "large"))
+            write_large_file(os.path.join(files_folder, "large", "log-large.txt"), options.large_file_size,
+                             os.path.join(files_folder, "log-00000.txt"))
+        print("%d files, %d bytes, %d putters" % (options.files, total_size, options.processes))
+        for source in sources:
+            if source == "tree":
+                arguments = ["--processes", str(options.processes), files_folder]
+                size = total_size + options.large_file_size
+            else:
+                arguments = ["--processes", str(options.processes), "--walk", "tar", tarballs[source]]
+                size = total_size
+            result = run(options, arguments, store)
+            if result["status"]:
+                print("%-8s failed with status %d" % (source, result["status"]))
+                return 1
+            report(source, result, size)
+            files = source_files(source, files_folder)
+            differing = differing_objects(store, files)
+            if differing:
+                print("%-8s %d objects missing or different from their file, e.g. %s" % (source, len(differing), differing[0]))
+                return 1
+            if os.listdir(os.path.join(store, "parts")):
+                print("%-8s multipart uploads left behind" % source)
+                return 1
+            # the large file is uploaded in parts by default (over 64 MB)
+            if source == "tree" and options.large_file_size > 64 * 1024 * 1024:
+                large_path = os.path.join(files_folder, "large", "log-large.txt")
+                run(options, arguments, store, failing_part=2)
+                aborted = differing_objects(store, files) == [large_path] and not os.listdir(os.path.join(store, "parts"))
+                print("%-8s a failed part of the large file %s" % (
+                    source, "aborts its multipart upload" if aborted else "leaves its multipart upload behind or other objects missing"))
+                if not aborted:
+                    return 1
+    finally:
+        shutil.rmtree(folder)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
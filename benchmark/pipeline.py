@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# Offline benchmark of full orchestrator sequences.
+#
+# S3 and EMR are replaced by the in-process fakes in benchmark/fakes.py and
+# Redshift by a local PostgreSQL, then the given actions run through
+# orchestrator.run() exactly as from the command line. For every run it
+# reports:
+#   - wall time of the whole sequence
+#   - service time: simulated cluster provisioning and step execution
+#   - poll waste: time between a cluster/step finishing and the orchestrator
+#     noticing it (it overlaps service time when steps are queued ahead, as
+#     in backfill, so the overhead can then be negative)
+#   - upload time and throughput of the S3 uploads
+#   - SQL time
+#   - client time: importing and initializing the lazily created clients
+#   - orchestration overhead: whatever is left of the wall time
+#
+# usage: python -m benchmark.pipeline [options] [action ...]
+# default actions: upload_mapper launch_emr mapreduce copy_output_to_redshift
+
+import logging
+import os
+import random
+import sys
+import time
+from optparse import OptionParser, Values
+
+root_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, root_folder)
+
+import defaults
+import orchestrator
+from benchmark.fakes import FakeEmrConnection, FakeS3Connection, LocalRedshiftConnection, split_s3_path, step_output
+from timeline import timeline
+
+default_actions = ["upload_mapper", "launch_emr", "mapreduce", "copy_output_to_redshift"]
+
+
+# Writes synthetic mapper output rows under the output path of a finished step
+# (generated once, so the fake step does not add to the measured overhead)
+def output_writer(s3_connection, rows):
+    lines = []
+    for row in range(rows):
+        lines.append("%02d/05/2014|%s|%d|%d" % (1 + row % 28, random.choice(["PMI", "BCN", "MAD", "PMI#TFS"]), random.randint(0, 365), random.randint(0, 500)))
+    content = "\n".join(lines) + "\n"
+
+    def write_output(step):
+        bucket_name, prefix = split_s3_path(step_output(step))
+        key = s3_connection.get_bucket(bucket_name).new_key(prefix + "part-m-00000")
+        # written by the cluster, not uploaded by the orchestrator
+        key.upload_bandwidth = 0
+        key.set_contents_from_string(content)
+    return write_output
+
+
+# Options of prepare() for quick checks: short fake latencies and few output
+# rows. Redshift is only connected to (the local PostgreSQL) by actions that use it
+def fake_options(**overrides):
+    options = dict(upload_bandwidth=0, cluster_latency=0.2, step_latency=0.2, output_rows=10, poll=0.05,
+                   db_host="localhost", db_port="5432", db_name="postgres", db_user="postgres", db_password="")
+    options.update(overrides)
+    return Values(options)
+
+
+# Prints the outcome of a check and returns it
+def check(description, condition):
+    print("%-60s %s" % (description, "ok" if condition else "FAILED"))
+    return condition
+
+
+# Points the orchestrator services at fresh fakes and resets its state
+def prepare(options):
+    s3_connection = FakeS3Connection(upload_bandwidth=options.upload_bandwidth)
+    emr_connection = FakeEmrConnection(cluster_latency=options.cluster_latency,
+                                       step_latency=options.step_latency,
+                                       on_step_completed=output_writer(s3_connection, options.output_rows),
+                                       s3_connection=s3_connection)
+    emr_parameters = dict(orchestrator.emr_parameters, emr_status_wait=options.poll, step_status_wait=options.poll)
+    redshift_parameters = {
+        "db_name": options.db_name,
+        "db_user": options.db_user,
+        "db_password": options.db_password,
+        "db_port": options.db_port,
+        "db_host": options.db_host
+    }
+
+    def build_s3(module):
+        manager = module.S3Manager(orchestrator.s3_parameters)
+        manager.connection = s3_connection
+        return manager
+
+    def build_emr(module):
+        manager = module.EmrManager(emr_parameters)
+        manager.connection = emr_connection
+        return manager
+
+    orchestrator.registry.register("s3", "aws.s3_manager", build_s3)
+    orchestrator.registry.register("emr", "aws.emr_manager", build_emr)
+    orchestrator.registry.register("redshift", "benchmark.fakes", lambda module: LocalRedshiftConnection(redshift_parameters, s3_connection))
+    orchestrator.registry.reset()
+    orchestrator.mapper_uploaded = False
+    orchestrator.jar_uploaded = False
+    orchestrator.copy_to_local_uploaded = False
+    orchestrator.stage_artifacts_uploaded = False
+    defaults.cluster_id = None
+    defaults.step_id = None
+    defaults.timeline_path = None
+    defaults.metrics_path = None
+    defaults.run_state_path = None
+    defaults.result_cache_path = None
+    defaults.step_reports_path = None
+    defaults.report_after_mapreduce = False
+    defaults.step_report_wait = 0
+    defaults.current_output_path = None
+    timeline.reset()
+    return emr_connection
+
+
+# Recreates the table loaded by copy_output_to_redshift, without rollups
+def prepare_table():
+    orchestrator.registry.get("redshift").execute("DROP TABLE IF EXISTS " + defaults.table_name)
+    orchestrator.registry.get("rollups").drop()
+    orchestrator.create_redshift_table()
+
+
+def measure(actions, options):
+    emr_connection = prepare(options)
+    if "copy_output_to_redshift" in actions or "backfill" in actions:
+        prepare_table()
+        timeline.reset()
+    registry = orchestrator.registry
+    setup_client_time = sum(registry.import_times.values()) + sum(registry.init_times.values())
+    start = time.time()
+    orchestrator.run(actions)
+    wall = time.time() - start
+    uploads = timeline.find("s3.upload")
+    upload_time = sum(span.duration for span in uploads)
+    upload_bytes = sum(span.attributes["bytes"] for span in uploads)
+    sql_time = sum(span.duration for span in timeline.find("sql.execute"))
+    client_time = sum(registry.import_times.values()) + sum(registry.init_times.values()) - setup_client_time
+    service_time = emr_connection.service_time()
+    poll_waste = emr_connection.poll_waste()
+    return {
+        "wall": wall,
+        "service": service_time,
+        "poll_waste": poll_waste,
+        "upload": upload_time,
+        "upload_throughput": upload_bytes / upload_time if upload_time else 0.0,
+        "sql": sql_time,
+        "clients": client_time,
+        "overhead": wall - service_time - poll_waste - upload_time - sql_time - client_time
+    }
+
+
+def report(label, result):
+    print("%-8s wall %8.3fs  service %8.3fs  poll waste %8.3fs  upload %8.3fs (%10.0f bytes/s)  sql %8.3fs  clients %8.3fs  overhead %8.3fs" % (
+        label, result["wall"], result["service"], result["poll_waste"], result["upload"],
+        result["upload_throughput"], result["sql"], result["clients"], result["overhead"]))
+
+
+def main(argv):
+    parser = OptionParser(usage="python -m benchmark.pipeline [options] [action ...]")
+    parser.add_option("--runs", default=3, type=int, help="number of runs")
+    parser.add_option("--poll", default=0.2, type=float, help="EMR status polling interval in seconds")
+    parser.add_option("--cluster-latency", default=1.0, type=float, help="seconds until a fake cluster is WAITING")
+    parser.add_option("--step-latency", default=1.0, type=float, help="seconds each fake step runs")
+    parser.add_option("--upload-bandwidth", default=0, type=int, help="fake S3 upload bandwidth in bytes/s (0: unlimited)")
+    parser.add_option("--output-rows", default=10000, type=int, help="rows written by each fake step")
+    parser.add_option("--db-host", default="localhost", help="local PostgreSQL host")
+    parser.add_option("--db-port", default="5432", help="local PostgreSQL port")
+    parser.add_option("--db-name", default="postgres", help="local PostgreSQL database")
+    parser.add_option("--db-user", default="postgres", help="local PostgreSQL user")
+    parser.add_option("--db-password", default="", help="local PostgreSQL password")
+    parser.add_option("--timeline", metavar="FILENAME", help="write the timeline of the last run as json lines")
+    options, actions = parser.parse_args(argv[1:])
+    logging.getLogger().setLevel(logging.WARNING)
+    actions = actions or default_actions
+    print("actions: " + " ".join(actions))
+    results = []
+    for run in range(options.runs):
+        results.append(measure(actions, options))
+        report("run %d" % (run + 1), results[-1])
+    average = dict((field, sum(result[field] for result in results) / len(results)) for field in results[0])
+    report("average", average)
+    if options.timeline:
+        timeline.write_jsonl(options.timeline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# Compares dashboard queries over the raw table with the same queries over
+# the daily rollups of redshift/rollup_manager.py, on a local PostgreSQL
+# standing in for Redshift.
+#
+# The table is filled with --days days of synthetic mapper output, the
+# rollups are built once, then --new-days more days go through
+# copy_output_to_redshift and update_rollups like a daily run, checking that
+# only the new date is updated each time. The last day is then replaced by
+# corrected rows (as many as before), which must be updated too. Every query
+# must give the same result on both sides before its latency (median of
+# --repeats) is shown.
+#
+# usage: python -m benchmark.rollups [options]
+
+import io
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+root_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, root_folder)
+
+import defaults
+import orchestrator
+from benchmark import pipeline
+
+destinations = ["PMI", "BCN", "MAD", "TFS", "LPA", "AGP", "IBZ", "LON", "PAR", "ROM", "BER", "NYC", "MIA", "CUN", "PUJ", "DXB"]
+
+# Dashboard queries as (name, query over the table, query over the rollups)
+queries = [
+    ("hotels by destination and days advance",
+     "SELECT destination, %(bucket)s, COUNT(*), SUM(hotels_returned) FROM %(table)s GROUP BY 1, 2",
+     "SELECT destination, days_advance_bucket, SUM(requests), SUM(hotels_returned) FROM suppliers_daily_destination GROUP BY 1, 2"),
+    ("requests without hotels by days advance",
+     "SELECT %(bucket)s, COUNT(*), SUM(CASE WHEN hotels_returned = 0 THEN 1 ELSE 0 END) FROM %(table)s GROUP BY 1",
+     "SELECT days_advance_bucket, SUM(requests), SUM(no_hotels) FROM suppliers_daily_advance GROUP BY 1"),
+    ("hotels by destination on the last day",
+     "SELECT destination, COUNT(*), SUM(hotels_returned) FROM %(table)s WHERE request_date = '%(last_day)s' GROUP BY 1",
+     "SELECT destination, SUM(requests), SUM(hotels_returned) FROM suppliers_daily_destination WHERE request_date = '%(last_day)s' GROUP BY 1")
+]
+
+
+# Mapper output rows of one request date: request_date|destination|days_advance|hotels_returned
+def day_rows(day, rows):
+    request_date = day.strftime("%d/%m/%Y")
+    lines = []
+    for row in range(rows):
+        destination = random.choice(destinations)
+        if random.random() < 0.2:
+            destination = "#".join(sorted(set([destination, random.choice(destinations)])))
+        # a few dates the mapper couldn't parse
+        days_advance = -1 if random.random() < 0.01 else int(random.expovariate(1 / 40.0))
+        hotels = 0 if random.random() < 0.1 else random.randint(1, 500)
+        lines.append("%s|%s|%d|%d" % (request_date, destination, days_advance, hotels))
+    return "\n".join(lines) + "\n"
+
+
+def median_latency(redshift, statement, repeats):
+    latencies = []
+    for repeat in range(repeats):
+        start = time.time()
+        rows = redshift.query(statement)
+        latencies.append(time.time() - start)
+    return sorted(latencies)[len(latencies) // 2], sorted(rows)
+
+
+def main(argv):
+    parser = OptionParser(usage="python -m benchmark.rollups [options]")
+    parser.add_option("--days", default=90, type=int, help="days in the table before the rollups are built")
+    parser.add_option("--new-days", default=3, type=int, help="days loaded afterwards, one at a time")
+    parser.add_option("--rows-per-day", default=20000, type=int, help="rows of each day")
+    parser.add_option("--repeats", default=5, type=int, help="runs of each query")
+    parser.add_option("--db-host", default="localhost", help="local PostgreSQL host")
+    parser.add_option("--db-port", default="5432", help="local PostgreSQL port")
+    parser.add_option("--db-name", default="postgres", help="local PostgreSQL database")
+    parser.add_option("--db-user", default="postgres", help="local PostgreSQL user")
+    parser.add_option("--db-password", default="", help="local PostgreSQL password")
+    options, arguments = parser.parse_args(argv[1:])
+    logging.getLogger().setLevel(logging.WARNING)
+    random.seed(42)
+    pipeline.prepare(pipeline.fake_options(db_host=options.db_host, db_port=options.db_port, db_name=options.db_name,
+                                           db_user=options.db_user, db_password=options.db_password))
+    pipeline.prepare_table()
+    redshift = orchestrator.registry.get("redshift")
+    first_day = datetime(2014, 1, 1)
+    for number in range(options.days):
+        redshift.cursor.copy_expert("COPY " + defaults.table_name + " FROM STDIN WITH DELIMITER '|'",
+                                    io.BytesIO(day_rows(first_day + timedelta(days=number), options.rows_per_day).encode("utf-8")))
+    redshift.execute("ANALYZE " + defaults.table_name)
+    results = []
+
+    start = time.time()
+    updated = orchestrator.update_redshift_rollups()
+    print("%d days, %d rows: rollups built in %.3fs" % (options.days, options.days * options.rows_per_day, time.time() - start))
+    results.append(pipeline.check("every date is rolled up", all(len(dates) == options.days for dates in updated.values())))
+
+    s3_bucket = orchestrator.registry.get("s3").connection.get_bucket(defaults.bucket_name)
+    for number in range(options.days, options.days + options.new_days + 1):
+        day = first_day + timedelta(days=min(number, options.days + options.new_days - 1))
+        defaults.current_output_path = defaults.output_remote_path + day.strftime("%Y%m%d") + "-%d/" % number
+        s3_bucket.new_key(defaults.current_output_path[1:] + "part-00000").set_contents_from_string(day_rows(day, options.rows_per_day))
+        if number == options.days + options.new_days:
+            redshift.execute("DELETE FROM " + defaults.table_name + " WHERE request_date = '" + day.strftime("%d/%m/%Y") + "'")
+        orchestrator.run(["copy_output_to_redshift"])
+        start = time.time()
+        updated = orchestrator.update_redshift_rollups()
+        print("day %s %s: rollups updated in %.3fs" % (day.strftime("%d/%m/%Y"), "reloaded" if number == options.days + options.new_days else "loaded",
+                                                       time.time() - start))
+        results.append(pipeline.check("only " + day.strftime("%d/%m/%Y") + " is updated",
+                                      all(dates == [day.strftime("%d/%m/%Y")] for dates in updated.values())))
+    updated = orchestrator.update_redshift_rollups()
+    results.append(pipeline.check("nothing to update without new loads", not any(updated.values())))
+    redshift.execute("ANALYZE")
+
+    parameters = {"table": defaults.table_name, "bucket": orchestrator.registry.get("rollups").expression("days_advance_bucket"),
+                  "last_day": day.strftime("%d/%m/%Y")}
+    for name, table_query, rollup_query in queries:
+        table_latency, table_rows = median_latency(redshift, table_query % parameters, options.repeats)
+        rollup_latency, rollup_rows = median_latency(redshift, rollup_query % parameters, options.repeats)
+        results.append(pipeline.check(name + ": same result", table_rows == rollup_rows))
+        print("  table %8.1f ms  rollup %8.1f ms  (%.0fx)" % (table_latency * 1000, rollup_latency * 1000, table_latency / rollup_latency))
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
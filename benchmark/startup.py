@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Startup time benchmark for orchestrator actions.
+#
+# Every action runs in a fresh interpreter so that module imports are not
+# shared between measurements. For each action it reports the time spent
+# importing orchestrator.py, importing and initializing each client the
+# action used, and running the action itself.
+#
+# Actions run against the fakes of benchmark/pipeline.py (and the local
+# PostgreSQL for Redshift), never against the configured AWS account. The
+# clients' modules are imported and their managers built as usual, only
+# their connections are replaced, so the run time is the fake's.
+#
+# usage: python -m benchmark.startup action [action ...]
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+root_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+# runs a single action against the fakes and prints its timings as json (child process)
+def measure(action):
+    sys.path.insert(0, root_folder)
+    start = time.time()
+    import orchestrator
+    imported = time.time()
+    from benchmark import pipeline
+    pipeline.prepare(pipeline.fake_options())
+    if action in ("copy_output_to_redshift", "delete_redshift_table", "drop_redshift_table"):
+        pipeline.prepare_table()
+        orchestrator.registry.reset()
+    started = time.time()
+    orchestrator.orchestrator[action]()
+    finished = time.time()
+    registry = orchestrator.registry
+    clients_time = sum(registry.import_times.values()) + sum(registry.init_times.values())
+    print(json.dumps({
+        "action": action,
+        "orchestrator_import": imported - start,
+        "client_import": registry.import_times,
+        "client_init": registry.init_times,
+        "run": finished - started - clients_time
+    }))
+
+
+def report(result):
+    print("%s" % result["action"])
+    print("  import orchestrator.py  %8.3fs" % result["orchestrator_import"])
+    for name in sorted(result["client_import"]):
+        print("  %-10s import       %8.3fs" % (name, result["client_import"][name]))
+        print("  %-10s init         %8.3fs" % (name, result["client_init"][name]))
+    print("  run                     %8.3fs" % result["run"])
+
+
+def main(argv):
+    if len(argv) > 2 and argv[1] == "--child":
+        measure(argv[2])
+        return 0
+    if len(argv) < 2:
+        print("usage: python -m benchmark.startup action [action ...]")
+        return 1
+    for action in argv[1:]:
+        output = subprocess.check_output([sys.executable, "-m", "benchmark.startup", "--child", action], cwd=root_folder)
+        report(json.loads(output.splitlines()[-1]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
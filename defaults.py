@@ -17,9 +17,20 @@ master_type = "m3.xlarge"
 slave_type = "m1.large"
 num_instances = 10
 ami_version = "3.3.1"
+# Instance groups: on-demand master and num_instances - 1 core nodes, plus a
+# task group of task_type nodes on spot instances (when task_bid_price is set,
+# in USD/hour). grow_task_group / shrink_task_group resize the task group to
+# task_instances_heavy / task_instances around heavy steps
+use_instance_groups = True
+task_type = "m1.large"
+task_instances = 0
+task_instances_heavy = 10
+task_bid_price = "0.10"
 log_dir = "/logs"
 emr_status_wait = 20
 step_status_wait = 20
+# consecutive failed step status polls before the steps are given up as ERROR
+step_status_retries = 5
 emr_cluster_name = "suppliers-integration-emr"
 cluster_id = None
 step_type = "jar"
@@ -32,10 +43,22 @@ step_mapper_script = "mapper.py"
 step_mapper = "s3n://" + bucket_name + scripts_remote_path + step_mapper_script
 step_copy_to_local_script = "copy_to_local.sh"
 step_copy_to_local_s3 = "s3n://" + bucket_name + scripts_remote_path + step_copy_to_local_script
+step_stage_artifacts_script = "stage_artifacts.sh"
+step_stage_artifacts_s3 = "s3://" + bucket_name + scripts_remote_path + step_stage_artifacts_script
+# artifacts copied to every node by a bootstrap action while the cluster is
+# provisioned, as (s3 path, local folder), by step_type: only streaming steps
+# run the mapper. When the copy_to_local artifacts are here, the
+# copy_to_local step is not needed. Empty: no bootstrap action
+staged_artifacts = {
+    "streaming": [(step_mapper, "/home/hadoop/")],
+    "jar": []
+}
 step_reducer = "NONE"
 step_input = "s3n://" + bucket_name + "/input/SuppliersMonitor.log-20140524.bz2"
 #step_input = "s3n://" + bucket_name + "/input/"
 step_output = "s3n://" + bucket_name + output_remote_path
+# output of the last mapreduce (set when it runs or reuses a cached result)
+current_output_path = None
 # Redshift
 db_name = "tuiinnovationredshift"
 db_user = "dlafuente"
@@ -43,3 +66,44 @@ db_password = "SonFangos100"
 db_port = "5439"
 db_host = "tuiinnovation.ccxabt6pla67.eu-west-1.redshift.amazonaws.com"
 table_name = "suppliers"
+# Daily rollups of table_name updated by update_rollups, as table name ->
+# grouping columns besides request_date. days_advance_bucket is days_advance
+# rounded down to the closest of days_advance_buckets
+rollup_tables = {
+    "suppliers_daily_destination": ["destination", "days_advance_bucket"],
+    "suppliers_daily_advance": ["days_advance_bucket"]
+}
+days_advance_buckets = [0, 1, 2, 3, 7, 14, 30, 60, 90, 180, 365]
+# request dates loaded since the last update_rollups (used when there are rollup_tables)
+load_log_table = "suppliers_loads"
+# Backfill (one step per day, both dates included, format YYYYMMDD)
+backfill_start = "20140501"
+backfill_end = "20140531"
+backfill_input = "s3n://" + bucket_name + "/input/SuppliersMonitor.log-%s.bz2"
+# steps submitted ahead to the cluster. AMI 3.x runs one step at a time, so
+# this keeps the next days queued rather than running them concurrently
+backfill_concurrency = 2
+# parallel Redshift loads of finished days
+backfill_load_workers = 2
+# Local files below (reports, state, cache, instrumentation) are relative to
+# the orchestrator folder, whatever the working directory
+# Performance report of a mapreduce step, built from the EMR logs by the
+# report_step action and saved here (None: only logged)
+step_reports_path = "./step_reports/"
+# also build the report right after each mapreduce step that runs. Off by
+# default: waiting for the logs delays the next actions while the cluster idles
+report_after_mapreduce = False
+# seconds the report after a mapreduce step waits for EMR to push its logs
+# to S3 (every 5 minutes). The report lists the logs still missing after that
+step_report_wait = 360
+log_analyzer_workers = 8
+# map attempts taking longer than this times the median are reported as stragglers
+straggler_factor = 1.5
+# Outputs of completed actions, used to resume failed runs (None: don't persist)
+run_state_path = "./run_state.json"
+# Cached mapreduce results (None: keep the cache only in memory)
+result_cache_path = "./result_cache.json"
+result_cache_max_entries = 10
+# Instrumentation (set to None to disable)
+timeline_path = "./timeline.jsonl"
+metrics_path = "./metrics.prom"
@@ -1,8 +1,10 @@
 import java.util.Arrays;
-import java.util.Date;
+import java.util.HashMap;
 import java.util.concurrent.TimeUnit;
 import java.text.ParseException;
 import java.text.SimpleDateFormat;
+import java.util.regex.Matcher;
+import java.util.regex.Pattern;
 
 import org.apache.hadoop.conf.Configuration;
 import org.apache.hadoop.fs.Path;
@@ -19,38 +21,87 @@ import org.apache.hadoop.util.GenericOptionsParser;
 
 public class MapReduce {
 
-    public static class Map extends Mapper<Object, Text, Text, Text> {
+    // Turns an availability log line into "request date|destinations|days in advance|hotels returned".
+    // Kept apart from the mapper so it can be benchmarked without a Hadoop context. Not thread safe:
+    // it reuses its matcher, buffers and date cache between records.
+    public static class RecordFormatter {
 
-        public void map(Object key, Text value, Context context) {
-            String regex = new String("^\\d{2}/\\d{2}/\\d{4}\\s\\S+\\|\\d+\\|AVA.*");
-            if (!value.toString().matches(regex)) {
-                return;
+        private static final Pattern AVAILABILITY = Pattern.compile("^\\d{2}/\\d{2}/\\d{4}\\s\\S+\\|\\d+\\|AVA.*");
+        private static final int FIELDS = 15;
+        private static final int MAX_CACHED_DATES = 100000;
+        private static final long UNPARSEABLE = Long.MIN_VALUE;
+
+        private final Matcher matcher = AVAILABILITY.matcher("");
+        private final int[] separators = new int[FIELDS];
+        private final StringBuilder builder = new StringBuilder(128);
+        private final SimpleDateFormat dateFormat = new SimpleDateFormat("dd/MM/yyyy");
+        // parsed time of each date string seen, so every date is parsed only once
+        private final HashMap<String, Long> dates = new HashMap<String, Long>();
+
+        // Returns the formatted record, null if the line is not a valid availability
+        public String format(String line) {
+            if (!matcher.reset(line).matches()) {
+                return null;
+            }
+            // positions of the first 14 separators; like String.split, trailing empty fields are not counted
+            int fields = 1;
+            int lastField = 0;
+            for (int i = 0; i < line.length(); i++) {
+                if (line.charAt(i) == '|') {
+                    if (fields == FIELDS) {
+                        // more than 15 fields unless all the remaining ones are empty
+                        for (int j = i + 1; j < line.length(); j++) {
+                            if (line.charAt(j) != '|') {
+                                return null;
+                            }
+                        }
+                        break;
+                    }
+                    separators[fields++] = i;
+                    if (i + 1 < line.length() && line.charAt(i + 1) != '|') {
+                        lastField = fields;
+                    }
+                }
+            }
+            if (lastField != FIELDS) {
+                return null;
             }
-            String[] items = value.toString().split("\\|");
-            SimpleDateFormat formatter = new SimpleDateFormat("dd/MM/yyyy");
-            if(items.length == 15) {
-                String requestDateString = new String(items[0].substring(0,10));
-                String destination = new String(this.sortDestinations(items[4]));
-                String entryDateString = new String(items[6]);
-                String numberHotelsReturned = new String(items[13]);
-                int daysDiff = -1;
-                // parse dates
+            String requestDateString = line.substring(0, 10);
+            String destination = sortDestinations(field(line, 4));
+            String entryDateString = field(line, 6);
+            int daysDiff = -1;
+            long requestTime = parseDate(requestDateString);
+            long entryTime = parseDate(entryDateString);
+            if (requestTime != UNPARSEABLE && entryTime != UNPARSEABLE) {
+                daysDiff = (int)TimeUnit.DAYS.convert(entryTime - requestTime, TimeUnit.MILLISECONDS);
+            }
+            builder.setLength(0);
+            builder.append(requestDateString).append('|').append(destination).append('|').append(daysDiff).append('|');
+            builder.append(line, separators[13] + 1, separators[14]);
+            return builder.toString();
+        }
+
+        // Field of the line being formatted, for indexes below 14
+        private String field(String line, int index) {
+            return line.substring(separators[index] + 1, separators[index + 1]);
+        }
+
+        private long parseDate(String date) {
+            Long time = dates.get(date);
+            if (time == null) {
                 try {
-                    long diff = formatter.parse(entryDateString).getTime() - formatter.parse(requestDateString).getTime();
-                    daysDiff = (int)TimeUnit.DAYS.convert(diff, TimeUnit.MILLISECONDS);
+                    time = dateFormat.parse(date).getTime();
                 }
                 catch (ParseException e) {
                     e.printStackTrace();
+                    time = UNPARSEABLE;
                 }
-                // print result
-                Text result = new Text(requestDateString + "|" + destination + "|" + daysDiff + "|" + numberHotelsReturned);
-                try {
-                    context.write(result, null);
-                }
-                catch (Exception e) {
-                    e.printStackTrace();
+                if (dates.size() >= MAX_CACHED_DATES) {
+                    dates.clear();
                 }
+                dates.put(date, time);
             }
+            return time;
         }
 
         private String sortDestinations(String destinations) {
@@ -59,7 +110,40 @@ public class MapReduce {
                 return destinations;
             }
             Arrays.sort(elements);
-            return Arrays.toString(elements).replace(", ", "#").replaceAll("[\\[\\]]", "");
+            builder.setLength(0);
+            for (int i = 0; i < elements.length; i++) {
+                String element = elements[i];
+                if (element.indexOf('[') >= 0 || element.indexOf(']') >= 0 || element.indexOf(", ") >= 0) {
+                    // the old output mangled these; keep it byte for byte
+                    return Arrays.toString(elements).replace(", ", "#").replaceAll("[\\[\\]]", "");
+                }
+                if (i > 0) {
+                    builder.append('#');
+                }
+                builder.append(element);
+            }
+            return builder.toString();
+        }
+    }
+
+    public static class Map extends Mapper<Object, Text, Text, Text> {
+
+        private final RecordFormatter formatter = new RecordFormatter();
+        // the output format writes the record before write returns, so it can be reused
+        private final Text result = new Text();
+
+        public void map(Object key, Text value, Context context) {
+            String record = formatter.format(value.toString());
+            if (record == null) {
+                return;
+            }
+            result.set(record);
+            try {
+                context.write(result, null);
+            }
+            catch (Exception e) {
+                e.printStackTrace();
+            }
         }
     }
 
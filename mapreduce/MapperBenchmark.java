@@ -0,0 +1,161 @@
+import java.io.BufferedReader;
+import java.io.FileReader;
+import java.io.IOException;
+import java.text.ParseException;
+import java.text.SimpleDateFormat;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.List;
+import java.util.Random;
+import java.util.concurrent.TimeUnit;
+
+// Compares MapReduce.RecordFormatter with the mapper it replaced, on a log file or on synthetic
+// availability lines. Both must produce the same output for every line before timings are shown.
+//
+// usage: ./run_benchmark.sh [lines] [passes] [log file]
+public class MapperBenchmark {
+
+    // The body of the previous MapReduce.Map.map, returning the record instead of writing it
+    static class LegacyFormatter {
+
+        public String format(String line) {
+            String regex = new String("^\\d{2}/\\d{2}/\\d{4}\\s\\S+\\|\\d+\\|AVA.*");
+            if (!line.matches(regex)) {
+                return null;
+            }
+            String[] items = line.split("\\|");
+            SimpleDateFormat formatter = new SimpleDateFormat("dd/MM/yyyy");
+            if(items.length == 15) {
+                String requestDateString = new String(items[0].substring(0,10));
+                String destination = new String(this.sortDestinations(items[4]));
+                String entryDateString = new String(items[6]);
+                String numberHotelsReturned = new String(items[13]);
+                int daysDiff = -1;
+                try {
+                    long diff = formatter.parse(entryDateString).getTime() - formatter.parse(requestDateString).getTime();
+                    daysDiff = (int)TimeUnit.DAYS.convert(diff, TimeUnit.MILLISECONDS);
+                }
+                catch (ParseException e) {
+                    // the mapper printed the stack trace, which would only slow down the timings here
+                }
+                return new String(requestDateString + "|" + destination + "|" + daysDiff + "|" + numberHotelsReturned);
+            }
+            return null;
+        }
+
+        private String sortDestinations(String destinations) {
+            String[] elements = destinations.split("#");
+            if (elements.length == 1) {
+                return destinations;
+            }
+            Arrays.sort(elements);
+            return Arrays.toString(elements).replace(", ", "#").replaceAll("[\\[\\]]", "");
+        }
+    }
+
+    private static final String[] DESTINATIONS = {"PMI", "BCN", "MAD", "LON", "PAR", "NYC", "ROM", "BER"};
+
+    // Availability lines like the ones in the logs, with some that must be skipped or handled specially
+    static List<String> syntheticLines(int count) {
+        Random random = new Random(42);
+        List<String> lines = new ArrayList<String>(count);
+        for (int i = 0; i < count; i++) {
+            int day = 1 + random.nextInt(28);
+            int month = 1 + random.nextInt(12);
+            String requestDate = String.format("%02d/%02d/2014", day, month);
+            String entryDate = String.format("%02d/%02d/2014", Math.min(28, day + random.nextInt(10)), month);
+            StringBuilder destinations = new StringBuilder(DESTINATIONS[random.nextInt(DESTINATIONS.length)]);
+            for (int extra = random.nextInt(4); extra > 0; extra--) {
+                destinations.append('#').append(DESTINATIONS[random.nextInt(DESTINATIONS.length)]);
+            }
+            String type = "AVA";
+            String hotels = Integer.toString(random.nextInt(500));
+            String last = "END";
+            switch (random.nextInt(20)) {
+                case 0: type = "VAL"; break;                        // not an availability
+                case 1: last = "END|extra"; break;                  // 16 fields
+                case 2: last = ""; break;                           // 14 fields once split
+                case 3: last = "END||"; break;                      // trailing empty fields
+                case 4: entryDate = "not a date"; break;            // unparseable date
+                case 5: destinations.append("#[X], Y"); break;      // mangled by the old join
+                case 6: entryDate = "31/02/2014"; break;            // lenient parsing rolls over
+                default: break;
+            }
+            lines.add(requestDate + " 10:" + String.format("%02d", random.nextInt(60)) + ":00|" + random.nextInt(100000) + "|" + type
+                      + "|1|" + destinations + "|2|" + entryDate + "|3|4|5|6|7|8|" + hotels + "|" + last);
+        }
+        return lines;
+    }
+
+    static List<String> fileLines(String path) throws IOException {
+        List<String> lines = new ArrayList<String>();
+        BufferedReader reader = new BufferedReader(new FileReader(path));
+        try {
+            for (String line = reader.readLine(); line != null; line = reader.readLine()) {
+                lines.add(line);
+            }
+        }
+        finally {
+            reader.close();
+        }
+        return lines;
+    }
+
+    public static void main(String[] args) throws Exception {
+        int count = args.length > 0 ? Integer.parseInt(args[0]) : 1000000;
+        int passes = args.length > 1 ? Integer.parseInt(args[1]) : 5;
+        List<String> lines = args.length > 2 ? fileLines(args[2]) : syntheticLines(count);
+
+        LegacyFormatter legacy = new LegacyFormatter();
+        MapReduce.RecordFormatter optimized = new MapReduce.RecordFormatter();
+        int records = 0;
+        for (String line : lines) {
+            String expected = legacy.format(line);
+            String actual = optimized.format(line);
+            if (expected == null ? actual != null : !expected.equals(actual)) {
+                System.err.println("Output differs for: " + line + "\n  legacy:    " + expected + "\n  optimized: " + actual);
+                System.exit(1);
+            }
+            if (expected != null) {
+                records++;
+            }
+        }
+        System.out.println(lines.size() + " lines, " + records + " records, outputs identical");
+
+        // the first pass warms up the JIT and is not reported
+        for (int pass = 0; pass <= passes; pass++) {
+            long legacyNanos = time(legacy, lines);
+            long optimizedNanos = time(optimized, lines);
+            if (pass > 0) {
+                System.out.println(String.format("pass %d: legacy %8.0f lines/s  optimized %8.0f lines/s  speedup %.1fx", pass,
+                                                 rate(lines.size(), legacyNanos), rate(lines.size(), optimizedNanos),
+                                                 (double)legacyNanos / optimizedNanos));
+            }
+        }
+    }
+
+    // the output lengths are summed so the JIT cannot drop the formatting
+    static long checksum;
+
+    static long time(LegacyFormatter formatter, List<String> lines) {
+        long start = System.nanoTime();
+        for (String line : lines) {
+            String record = formatter.format(line);
+            checksum += record == null ? 0 : record.length();
+        }
+        return System.nanoTime() - start;
+    }
+
+    static long time(MapReduce.RecordFormatter formatter, List<String> lines) {
+        long start = System.nanoTime();
+        for (String line : lines) {
+            String record = formatter.format(line);
+            checksum += record == null ? 0 : record.length();
+        }
+        return System.nanoTime() - start;
+    }
+
+    static double rate(int lines, long nanos) {
+        return lines * 1e9 / nanos;
+    }
+}
@@ -1,3 +1,3 @@
 #!/bin/bash
- javac -classpath ./jar/hadoop-common-2.4.0.jar:./jar/hadoop-mapreduce-client-core-2.4.0.jar:./jar/hadoop-annotations-2.4.0.jar:./jar/commons-cli-1.2.jar MapReduce.java -Xlint:deprecation
+ javac -classpath ./jar/hadoop-common-2.4.0.jar:./jar/hadoop-mapreduce-client-core-2.4.0.jar:./jar/hadoop-annotations-2.4.0.jar:./jar/commons-cli-1.2.jar -source 1.7 -target 1.7 MapReduce.java -Xlint:deprecation
  jar cf mr.jar MapReduce*.class
\ No newline at end of file
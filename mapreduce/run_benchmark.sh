@@ -0,0 +1,7 @@
+#!/bin/bash
+ classpath=./jar/hadoop-common-2.4.0.jar:./jar/hadoop-mapreduce-client-core-2.4.0.jar:./jar/hadoop-annotations-2.4.0.jar:./jar/commons-cli-1.2.jar
+ classes=$(mktemp -d)
+ javac -classpath $classpath -d $classes MapReduce.java MapperBenchmark.java -Xlint:deprecation && java -classpath $classes:$classpath MapperBenchmark "$@"
+ status=$?
+ rm -rf $classes
+ exit $status
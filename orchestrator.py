@@ -1,14 +1,17 @@
 #!/usr/bin/env python
 
+import json
 import logging
 import sys
 import os
+import threading
 import time
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 import defaults
-from boto.emr.step import StreamingStep
-from aws.s3_manager import S3Manager
-from aws.emr_manager import EmrManager
-from redshift.db_connection import DbConnection
+import run_state
+from services import ServiceRegistry
+from timeline import timeline
 from psycopg2 import Error
 
 # Logger level
@@ -17,12 +20,23 @@ logging.getLogger().setLevel(logging.INFO)
 # script to trigger the whole process
 
 # globals
+# Local files of the orchestrator (run state, result cache, timeline, metrics,
+# step reports) are relative to its folder, not to the working directory, so
+# runs started from elsewhere (e.g. cron) find the same state
+def _local_path(path):
+    if not path:
+        return None
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), path))
+
+# Clients are created lazily on first use, so actions only pay for the
+# clients they need (e.g. empty_bucket never connects to Redshift)
+registry = ServiceRegistry()
 # S3
 s3_parameters = {
     "access_key": defaults.access_key,
     "secret_key": defaults.secret_key
 }
-s3_manager = S3Manager(s3_parameters)
+registry.register("s3", "aws.s3_manager", lambda module: module.S3Manager(s3_parameters))
 # Elastic Mapreduce
 emr_parameters = {
     "region_name": defaults.region_name,
@@ -33,9 +47,10 @@ emr_parameters = {
     "log_dir": defaults.log_dir,
     "emr_status_wait": defaults.emr_status_wait,
     "step_status_wait": defaults.step_status_wait,
+    "step_status_retries": defaults.step_status_retries,
     "emr_cluster_name": defaults.emr_cluster_name
 }
-emr_manager = EmrManager(emr_parameters)
+registry.register("emr", "aws.emr_manager", lambda module: module.EmrManager(emr_parameters))
 # Redshift
 redshift_parameters = {
     "db_name": defaults.db_name,
@@ -44,18 +59,40 @@ redshift_parameters = {
     "db_port": defaults.db_port,
     "db_host": defaults.db_host
 }
-redshift_cursor = DbConnection(redshift_parameters).cursor
+registry.register("redshift", "redshift.db_connection", lambda module: module.DbConnection(redshift_parameters))
+# Daily rollups of table_name, updated after loads
+rollup_parameters = {
+    "table_name": defaults.table_name,
+    "load_log_table": defaults.load_log_table,
+    "rollup_tables": defaults.rollup_tables,
+    "days_advance_buckets": defaults.days_advance_buckets
+}
+registry.register("rollups", "redshift.rollup_manager", lambda module: module.RollupManager(rollup_parameters, registry.get("redshift")))
+# Step performance reports from the EMR logs, read with one S3 client per worker thread
+log_analyzer_parameters = {
+    "bucket_name": defaults.bucket_name,
+    "log_dir": defaults.log_dir,
+    "workers": defaults.log_analyzer_workers,
+    "straggler_factor": defaults.straggler_factor
+}
+registry.register("log_analyzer", "aws.log_analyzer", lambda module: module.LogAnalyzer(log_analyzer_parameters, lambda: registry.create("s3")))
+# Outputs of the actions completed in previous runs
+registry.register("run_state", "run_state", lambda module: module.RunState(_local_path(defaults.run_state_path)))
+# Outputs of previous mapreduce steps by inputs hash
+registry.register("result_cache", "result_cache", lambda module: module.ResultCache(_local_path(defaults.result_cache_path), defaults.result_cache_max_entries))
 # Mapper
 mapper_uploaded = False
 # Copy to local
 copy_to_local_uploaded = False
 # Jar uploaded
 jar_uploaded = False
+# Stage artifacts uploaded
+stage_artifacts_uploaded = False
 
 # create s3 bucket
 def create_s3_bucket():
     logging.info("Creating bucket: " + defaults.bucket_name)
-    s3_manager.create_bucket(defaults.bucket_name)
+    registry.get("s3").create_bucket(defaults.bucket_name)
     logging.info("Bucket: " + defaults.bucket_name + " created.")
 
 
@@ -69,11 +106,12 @@ def upload_mapper_to_s3_bucket():
     global mapper_uploaded
     logging.info("Uploading mapper script")
     current_folder = os.path.dirname(os.path.realpath(__file__))
-    s3_manager.upload_file(defaults.bucket_name, current_folder + "/mapreduce/mapper.py", defaults.scripts_remote_path + defaults.step_mapper_script, _upload_mapper_callback)
+    registry.get("s3").upload_file(defaults.bucket_name, current_folder + "/mapreduce/mapper.py", defaults.scripts_remote_path + defaults.step_mapper_script, _upload_mapper_callback)
     # wait until finished
     while not mapper_uploaded:
         time.sleep(1)
     logging.info("Mapper script uploaded")
+    return {"etag": registry.get("s3").get_etag(defaults.bucket_name, defaults.scripts_remote_path + defaults.step_mapper_script)}
 
 def _upload_mapper_callback(transmitted, total):
     global mapper_uploaded
@@ -86,11 +124,12 @@ def upload_jar_to_s3_bucket():
     global jar_uploaded
     logging.info("Uploading jar file")
     current_folder = os.path.dirname(os.path.realpath(__file__))
-    s3_manager.upload_file(defaults.bucket_name, current_folder + "/mapreduce/mr.jar", defaults.scripts_remote_path + "mr.jar", _upload_jar_callback)
+    registry.get("s3").upload_file(defaults.bucket_name, current_folder + "/mapreduce/mr.jar", defaults.scripts_remote_path + "mr.jar", _upload_jar_callback)
     # wait until finished
     while not jar_uploaded:
         time.sleep(1)
     logging.info("Jar uploaded")
+    return {"etag": registry.get("s3").get_etag(defaults.bucket_name, defaults.scripts_remote_path + "mr.jar")}
 
 def _upload_jar_callback(transmitted, total):
     global jar_uploaded
@@ -103,11 +142,12 @@ def upload_copy_to_local_to_s3_bucket():
     global copy_to_local_uploaded
     logging.info("Uploading copy_to_local script")
     current_folder = os.path.dirname(os.path.realpath(__file__))
-    s3_manager.upload_file(defaults.bucket_name, current_folder + "/bash/copy_to_local.sh", defaults.scripts_remote_path + defaults.step_copy_to_local_script, _upload_copy_to_local_callback)
+    registry.get("s3").upload_file(defaults.bucket_name, current_folder + "/bash/copy_to_local.sh", defaults.scripts_remote_path + defaults.step_copy_to_local_script, _upload_copy_to_local_callback)
     # wait until finished
     while not copy_to_local_uploaded:
         time.sleep(1)
     logging.info("Copy_to_local script uploaded")
+    return {"etag": registry.get("s3").get_etag(defaults.bucket_name, defaults.scripts_remote_path + defaults.step_copy_to_local_script)}
 
 def _upload_copy_to_local_callback(transmitted, total):
     global copy_to_local_uploaded
@@ -115,62 +155,221 @@ def _upload_copy_to_local_callback(transmitted, total):
     # only called once
     copy_to_local_uploaded = True
 
-# start EMR cluster
+# upload stage_artifacts.sh bootstrap script to s3 bucket
+def upload_stage_artifacts_to_s3_bucket():
+    global stage_artifacts_uploaded
+    logging.info("Uploading stage_artifacts script")
+    current_folder = os.path.dirname(os.path.realpath(__file__))
+    registry.get("s3").upload_file(defaults.bucket_name, current_folder + "/bash/stage_artifacts.sh", defaults.scripts_remote_path + defaults.step_stage_artifacts_script, _upload_stage_artifacts_callback)
+    # wait until finished
+    while not stage_artifacts_uploaded:
+        time.sleep(1)
+    logging.info("Stage_artifacts script uploaded")
+    return {"etag": registry.get("s3").get_etag(defaults.bucket_name, defaults.scripts_remote_path + defaults.step_stage_artifacts_script)}
+
+def _upload_stage_artifacts_callback(transmitted, total):
+    global stage_artifacts_uploaded
+    logging.info("Upload stage_artifacts callback. Transmitted: " + str(transmitted) + " - total: " + str(total))
+    # only called once
+    stage_artifacts_uploaded = True
+
+# start EMR cluster. The staged_artifacts of the step type are copied to the
+# nodes by a bootstrap action, in parallel with the cluster provisioning. The
+# bootstrap action fails the cluster if its script or an artifact is not in
+# the bucket, so the script is uploaded first when it isn't there or is out
+# of date, and the launch is refused when an artifact is missing
 def launch_emr_cluster():
     logging.info("Launching EMR Cluster with name: " + defaults.emr_cluster_name)
-    defaults.cluster_id = emr_manager.launch_cluster(defaults.master_type, defaults.slave_type, defaults.num_instances, defaults.ami_version)
+    artifacts = _staged_artifacts()
+    if artifacts:
+        s3_manager = registry.get("s3")
+        stage_script_md5 = run_state.file_md5(os.path.dirname(os.path.realpath(__file__)) + "/bash/stage_artifacts.sh")
+        if s3_manager.get_etag(defaults.bucket_name, defaults.scripts_remote_path + defaults.step_stage_artifacts_script) != '"' + stage_script_md5 + '"':
+            upload_stage_artifacts_to_s3_bucket()
+        missing = [s3_path for s3_path, local_folder in artifacts if not s3_manager.get_etags(s3_path)]
+        if missing:
+            logging.error("Artifacts to stage are not in the bucket: " + ", ".join(missing) + ". Upload them before launching the cluster")
+            return None
+    instance_groups = None
+    if defaults.use_instance_groups:
+        instance_groups = registry.get("emr").build_instance_groups(defaults.master_type, defaults.slave_type, defaults.num_instances - 1,
+                                                                    defaults.task_type, defaults.task_instances, defaults.task_bid_price)
+    defaults.cluster_id = registry.get("emr").launch_cluster(defaults.master_type, defaults.slave_type, defaults.num_instances, defaults.ami_version,
+                                                             artifacts = artifacts,
+                                                             stage_script = defaults.step_stage_artifacts_s3,
+                                                             instance_groups = instance_groups)
+    if _failed(defaults.cluster_id):
+        return None
     logging.info("EMR Cluster launched: " + defaults.cluster_id)
+    return {"cluster_id": defaults.cluster_id}
 
-# run copy_to_local.sh step in EMR cluster
+# run copy_to_local.sh step in EMR cluster. Not needed (and skipped) when the
+# mapper is already staged by the bootstrap action
 def run_copy_to_local_step():
+    if defaults.step_mapper in [s3_path for s3_path, local_folder in _staged_artifacts()]:
+        logging.info("Mapper already staged in cluster " + defaults.cluster_id + " by the bootstrap action. Skipping copy_to_local step")
+        return {"staged": True}
     logging.info("Running copy_to_local step in cluster: " + defaults.cluster_id + "with script path: " + defaults.step_copy_to_local_s3)
-    defaults.step_id = emr_manager.run_scripting_step(name = defaults.step_name,
+    defaults.step_id = registry.get("emr").run_scripting_step(name = defaults.step_name,
                                             cluster_id = defaults.cluster_id,
                                             script_path = defaults.step_copy_to_local_s3)
+    if _failed(defaults.step_id):
+        return None
     logging.info("Scripting step " + defaults.step_id + " completed in cluster " + defaults.cluster_id)
+    return {"step_id": defaults.step_id}
 
-# run mapreduce in EMR cluster
+# run mapreduce in EMR cluster. Results are cached by a hash of the step
+# inputs: if the same input, artifact and arguments already produced an
+# output that is still in the bucket unchanged, it is reused without running
+# the step. Each result is written to output_remote_path + <hash>/.
 def run_mapreduce():
+    s3_manager = registry.get("s3")
+    cache = registry.get("result_cache")
+    key = run_state.fingerprint(_mapreduce_inputs(defaults.step_input))
+    with timeline.span("result_cache.lookup", key=key) as span:
+        entry = cache.get(key)
+        if entry is not None and s3_manager.get_etags(_s3_output(entry["output_path"])) != entry["output_etags"]:
+            logging.info("Cached result " + key + " is no longer in the bucket. Invalidating it")
+            cache.remove(key)
+            entry = None
+        span.set("result", "miss" if entry is None else "hit")
+    if entry is not None:
+        cache.hit(key)
+        defaults.current_output_path = entry["output_path"]
+        logging.info("Reusing cached MapReduce output " + entry["output_path"] + ". Result cache: " + str(cache.stats()))
+        return {"output_path": entry["output_path"]}
+    cache.miss()
+    output_path = defaults.output_remote_path + key + "/"
+    # leftovers of an interrupted run would make hadoop refuse the output path
+    s3_manager.delete_files_with_prefix(defaults.bucket_name, output_path[1:])
     logging.info("Running MapReduce " + defaults.step_type + " step in cluster: " + defaults.cluster_id)
     run_step = run_streaming_mapreduce
     if (defaults.step_type == "jar"):
         run_step = run_jar_mapreduce
-    defaults.step_id = run_step();
+    defaults.step_id = run_step(_s3_output(output_path));
+    if _failed(defaults.step_id):
+        return None
     logging.info(defaults.step_type + " step " + defaults.step_id + " completed in cluster " + defaults.cluster_id)
+    for evicted in cache.put(key, output_path, s3_manager.get_etags(_s3_output(output_path)), defaults.cluster_id, defaults.step_id):
+        logging.info("Evicting cached MapReduce output " + evicted["output_path"])
+        s3_manager.delete_files_with_prefix(defaults.bucket_name, evicted["output_path"][1:])
+    defaults.current_output_path = output_path
+    logging.info("Result cache: " + str(cache.stats()))
+    if defaults.report_after_mapreduce:
+        # the step succeeded: a failing report must not stop the next actions
+        # (e.g. terminate_emr)
+        try:
+            report_step(defaults.step_report_wait)
+        except Exception as error:
+            logging.error("Could not build the report of step " + defaults.step_id + ": " + str(error))
+    return {"step_id": defaults.step_id, "output_path": output_path}
 
-def run_streaming_mapreduce():
-    return emr_manager.run_streaming_step(name = defaults.step_name,
+def run_streaming_mapreduce(output_path):
+    return registry.get("emr").run_streaming_step(name = defaults.step_name,
                                             cluster_id = defaults.cluster_id,
                                             mapper_path = defaults.step_mapper,
                                             reducer_path = defaults.step_reducer,
                                             input_path = defaults.step_input,
-                                            output_path = defaults.step_output)
+                                            output_path = output_path)
 
-def run_jar_mapreduce():
-    return emr_manager.run_jar_step(name = defaults.step_name,
+def run_jar_mapreduce(output_path):
+    return registry.get("emr").run_jar_step(name = defaults.step_name,
                                     cluster_id = defaults.cluster_id,
                                     jar_path = defaults.step_jar_path,
                                     class_name = defaults.step_jar_class_name,
                                     input_path = defaults.step_input,
-                                    output_path = defaults.step_output)
+                                    output_path = output_path)
+
+# performance report of the last mapreduce step, logged and written as json
+# to step_reports_path (failing to write it is logged, not raised). EMR
+# pushes the logs to S3 every few minutes, so while some are missing it is
+# rebuilt every step_status_wait seconds for up to wait seconds; after that
+# the report lists what is still missing and report_step can be run again later
+def report_step(wait=0):
+    cluster_id, step_id = _last_step()
+    if step_id is None:
+        logging.error("No mapreduce step to report on. Run mapreduce first")
+        return None
+    logging.info("Building performance report of step " + step_id + " from the logs of cluster " + cluster_id)
+    log_analyzer = registry.get("log_analyzer")
+    deadline = time.time() + wait
+    report = log_analyzer.analyze_step(cluster_id, step_id)
+    while report is not None and report["logs"]["missing"] and time.time() < deadline:
+        logging.info("Logs of step " + step_id + " not in S3 yet (" + ", ".join(report["logs"]["missing"]) + "). Retrying")
+        time.sleep(min(defaults.step_status_wait, max(0, deadline - time.time())))
+        report = log_analyzer.analyze_step(cluster_id, step_id)
+    if report is None:
+        return None
+    for line in log_analyzer.format_report(report):
+        logging.info(line)
+    reports_path = _local_path(defaults.step_reports_path)
+    if reports_path:
+        report_path = os.path.join(reports_path, step_id + ".json")
+        try:
+            if not os.path.isdir(reports_path):
+                os.makedirs(reports_path)
+            with open(report_path, "w") as report_file:
+                json.dump(report, report_file, indent=2, sort_keys=True)
+            logging.info("Step report written to " + report_path)
+        except (IOError, OSError) as error:
+            logging.error("Could not write step report " + report_path + ": " + str(error))
+    return report
+
+# forget all cached mapreduce results and delete their outputs
+def clear_result_cache():
+    logging.info("Clearing MapReduce result cache")
+    for entry in registry.get("result_cache").clear():
+        registry.get("s3").delete_files_with_prefix(defaults.bucket_name, entry["output_path"][1:])
+    logging.info("MapReduce result cache cleared")
+
+# (cluster id, step id) of the step that produced the most recently used
+# mapreduce result, the one run or reused by the last mapreduce
+def _last_step():
+    entry = registry.get("result_cache").latest()
+    if entry is not None and entry.get("step_id"):
+        return entry["cluster_id"], entry["step_id"]
+    return None, None
+
+# output path of the last mapreduce: the one run or reused in this run, or
+# else the most recently used result in the cache
+def _current_output_path():
+    if defaults.current_output_path:
+        return defaults.current_output_path
+    entry = registry.get("result_cache").latest()
+    if entry is not None:
+        return entry["output_path"]
+    return defaults.output_remote_path
+
+def _s3_output(output_path):
+    return "s3n://" + defaults.bucket_name + output_path
+
+# grow the task group of the cluster before a heavy step
+def grow_task_group():
+    logging.info("Growing task group to " + str(defaults.task_instances_heavy) + " instances in cluster: " + defaults.cluster_id)
+    registry.get("emr").resize_task_group(defaults.cluster_id, defaults.task_instances_heavy, defaults.task_type, defaults.task_bid_price)
+
+# shrink the task group of the cluster back after a heavy step
+def shrink_task_group():
+    logging.info("Shrinking task group to " + str(defaults.task_instances) + " instances in cluster: " + defaults.cluster_id)
+    registry.get("emr").resize_task_group(defaults.cluster_id, defaults.task_instances, defaults.task_type, defaults.task_bid_price)
 
 # terminate EMR cluster
 def terminate_emr_cluster():
     logging.info("Terminating cluster: " + defaults.cluster_id)
-    emr_manager.terminate_cluster(defaults.cluster_id)
+    registry.get("emr").terminate_cluster(defaults.cluster_id)
     logging.info("Cluster terminated: " + defaults.cluster_id)
 
 # create redshift_table
 def create_redshift_table():
     logging.info("Creating table " + defaults.table_name + " in Redshift")
     try:
-        redshift_cursor.execute("CREATE TABLE " + defaults.table_name + " \
+        registry.get("redshift").execute("CREATE TABLE " + defaults.table_name + " \
             ( \
               request_date     VARCHAR(10) NOT NULL,\
               destination      VARCHAR(1000) NOT NULL,\
               days_advance     INTEGER NOT NULL,\
               hotels_returned  INTEGER NOT NULL\
-            )")
+            ) SORTKEY(request_date)")
         logging.info("Table " + defaults.table_name + " created in Redshift")
     except Error as error:
         logging.error("Something went wrong while creating " + defaults.table_name + " table.")
@@ -180,20 +379,131 @@ def create_redshift_table():
 # copy contents of output to Redshift
 def copy_output_to_redshift():
     logging.info("Copying output into Redshift. This might take time. Check progress in your AWS Console")
+    if _prepare_load_log() and _copy_to_redshift(registry.get("redshift"), _current_output_path()):
+        return {"table_name": defaults.table_name}
+
+# creates the load log the loads record their dates in, when there are rollups. True if it worked
+def _prepare_load_log():
+    if not defaults.rollup_tables:
+        return True
+    try:
+        registry.get("rollups").create_load_log()
+        return True
+    except Error as error:
+        logging.error("Something went wrong while creating the " + defaults.load_log_table + " table.")
+        logging.error(error.pgerror)
+        logging.error(error.diag.message_detail)
+        return False
+
+# copies the part- files under output_path (e.g. /output/) into the table. True
+# if it worked. With rollups, the request dates loaded are recorded for
+# update_rollups
+def _copy_to_redshift(redshift, output_path):
     try:
-        s3_source = "s3://" + defaults.bucket_name + defaults.output_remote_path + "part-"
+        s3_source = "s3://" + defaults.bucket_name + output_path + "part-"
         credentials = "CREDENTIALS 'aws_access_key_id=" + defaults.access_key + ";aws_secret_access_key=" + defaults.secret_key + "'"
-        redshift_cursor.execute("COPY " + defaults.table_name + " FROM '" + s3_source + "' " + credentials + " DELIMITER '|' MAXERROR 10")
+        copy_options = " FROM '" + s3_source + "' " + credentials + " DELIMITER '|' MAXERROR 10"
+        if defaults.rollup_tables:
+            registry.get("rollups").copy(redshift, copy_options)
+        else:
+            redshift.execute("COPY " + defaults.table_name + copy_options)
+        return True
     except Error as error:
-        logging.error("Something went wrong while copying data to " + defaults.table_name + " table.")
+        logging.error("Something went wrong while copying data from " + output_path + " to " + defaults.table_name + " table.")
         logging.error(error.pgerror)
         logging.error(error.diag.message_detail)
+        return False
+
+# run one mapreduce step per day between backfill_start and backfill_end in
+# the cluster. Each day writes to its own output prefix and is loaded into
+# Redshift by a pool of workers as soon as its step completes, while the
+# next days are still running.
+# Days loaded by previous runs with the same inputs are skipped.
+def run_backfill():
+    days = _backfill_days()
+    logging.info("Backfilling " + str(len(days)) + " days (" + defaults.backfill_start + " - " + defaults.backfill_end + ") in cluster: " + defaults.cluster_id)
+    emr_manager = registry.get("emr")
+    state = registry.get("run_state")
+    steps = []
+    step_days = {}
+    fingerprints = {}
+    for day in list(days):
+        inputs = _mapreduce_inputs(defaults.backfill_input % day)
+        inputs["output_path"] = _backfill_output_path(day)
+        inputs["table_name"] = defaults.table_name
+        fingerprints[day] = run_state.fingerprint(inputs)
+        if state.completed("backfill:" + day, fingerprints[day]) is not None:
+            logging.info("Skipping backfill day " + day + ". It was loaded by a previous run with the same inputs")
+            days.remove(day)
+            continue
+        # hadoop refuses to write to an existing output path
+        registry.get("s3").delete_files_with_prefix(defaults.bucket_name, _backfill_output_path(day)[1:])
+        name = defaults.step_name + "-" + day
+        step_days[name] = day
+        steps.append(_build_mapreduce_step(name, defaults.backfill_input % day, defaults.step_output + day + "/"))
+    # built before the load workers use it
+    if not _prepare_load_log():
+        return None
+    workers = threading.local()
+    loads = {}
+    pool = ThreadPool(defaults.backfill_load_workers)
+
+    def load_day(day):
+        if not hasattr(workers, "redshift"):
+            workers.redshift = registry.create("redshift")
+        logging.info("Loading backfill day " + day + " into Redshift")
+        with timeline.span("backfill.load", day=day):
+            loaded = _copy_to_redshift(workers.redshift, _backfill_output_path(day))
+        if loaded:
+            state.record("backfill:" + day, fingerprints[day], {"output_path": _backfill_output_path(day)})
+        return loaded
+
+    def on_step_finished(name, step_id, state):
+        if state == u'COMPLETED':
+            day = step_days[name]
+            loads[day] = pool.apply_async(load_day, (day,))
+
+    states = emr_manager.run_steps(defaults.cluster_id, steps, defaults.backfill_concurrency, on_step_finished)
+    pool.close()
+    pool.join()
+    loaded = [day for day in days if day in loads and loads[day].get()]
+    failed = [day for day in days if day not in loaded]
+    logging.info("Backfill finished. " + str(len(loaded)) + " days loaded into Redshift in cluster " + defaults.cluster_id)
+    if failed:
+        logging.error("Backfill failed for days: " + ", ".join(failed))
+    return states
+
+def _backfill_days():
+    day = datetime.strptime(defaults.backfill_start, "%Y%m%d")
+    end = datetime.strptime(defaults.backfill_end, "%Y%m%d")
+    days = []
+    while day <= end:
+        days.append(day.strftime("%Y%m%d"))
+        day += timedelta(days=1)
+    return days
+
+def _backfill_output_path(day):
+    return defaults.output_remote_path + day + "/"
+
+# builds the step run by mapreduce for the configured step_type
+def _build_mapreduce_step(name, input_path, output_path):
+    if defaults.step_type == "jar":
+        return registry.get("emr").build_jar_step(name = name,
+                                                  jar_path = defaults.step_jar_path,
+                                                  class_name = defaults.step_jar_class_name,
+                                                  input_path = input_path,
+                                                  output_path = output_path)
+    return registry.get("emr").build_streaming_step(name = name,
+                                                    mapper_path = defaults.step_mapper,
+                                                    reducer_path = defaults.step_reducer,
+                                                    input_path = input_path,
+                                                    output_path = output_path)
 
 # vacuum redshift
 def vacuum_redshift():
     logging.info("Vacuuming database")
     try:
-        redshift_cursor.execute("vacuum")
+        registry.get("redshift").execute("vacuum")
         logging.info("Database vacuumed")
     except Error as error:
         logging.error("Something went wrong while vacuuming table.")
@@ -204,18 +514,33 @@ def vacuum_redshift():
 def analyze_redshift():
     logging.info("Analyzing database")
     try:
-        redshift_cursor.execute("analyze")
+        registry.get("redshift").execute("analyze")
         logging.info("Database analyzed")
     except Error as error:
         logging.error("Something went wrong while analyzing database.")
         logging.error(error.pgerror)
         logging.error(error.diag.message_detail)
 
+# update the daily rollups with the dates loaded since the last update, or
+# build them from the whole table when they don't exist yet
+def update_redshift_rollups():
+    logging.info("Updating rollups of table " + defaults.table_name)
+    try:
+        updated = registry.get("rollups").update()
+        logging.info("Rollups updated")
+        return updated
+    except Error as error:
+        logging.error("Something went wrong while updating rollups of " + defaults.table_name + " table.")
+        logging.error(error.pgerror)
+        logging.error(error.diag.message_detail)
+
 # delete redshift_table
 def delete_redshift_table():
     logging.info("Deleting contents of table " + defaults.table_name + " in Redshift")
     try:
-        redshift_cursor.execute("DELETE FROM " + defaults.table_name)
+        registry.get("redshift").execute("DELETE FROM " + defaults.table_name)
+        if defaults.rollup_tables:
+            registry.get("rollups").clear()
         logging.info("Contents of table " + defaults.table_name + " deleted in Redshift")
     except Error as error:
         logging.error("Something went wrong while deleting " + defaults.table_name + " table.")
@@ -226,7 +551,9 @@ def delete_redshift_table():
 def drop_redshift_table():
     logging.info("Dropping table " + defaults.table_name + " in Redshift")
     try:
-        redshift_cursor.execute("DROP TABLE " + defaults.table_name)
+        registry.get("redshift").execute("DROP TABLE " + defaults.table_name)
+        if defaults.rollup_tables:
+            registry.get("rollups").drop()
         logging.info("Table " + defaults.table_name + " was removed from Redshift")
     except Error as error:
         logging.error("Something went wrong while dropping " + defaults.table_name + " table.")
@@ -236,13 +563,15 @@ def drop_redshift_table():
 # deletes output from bucket
 def delete_output_from_bucket():
     logging.info("Deleting output in bucket: " + defaults.bucket_name)
-    s3_manager.delete_files_with_prefix(defaults.bucket_name, defaults.output_remote_path[1:])
+    registry.get("s3").delete_files_with_prefix(defaults.bucket_name, defaults.output_remote_path[1:])
+    registry.get("result_cache").clear()
     logging.info("Output deleted in bucket: " + defaults.bucket_name)
 
 # empty bucket
 def empty_bucket():
     logging.info("Emptying bucket: " + defaults.bucket_name)
-    s3_manager.empty_bucket(defaults.bucket_name)
+    registry.get("s3").empty_bucket(defaults.bucket_name)
+    registry.get("result_cache").clear()
     logging.info("Bucket empty: " + defaults.bucket_name)
 
 # the orchestrator
@@ -252,9 +581,15 @@ orchestrator = {
     "upload_mapper": upload_mapper_to_s3_bucket,
     "upload_copy_to_local": upload_copy_to_local_to_s3_bucket,
     "upload_jar": upload_jar_to_s3_bucket,
+    "upload_stage_artifacts": upload_stage_artifacts_to_s3_bucket,
     "launch_emr": launch_emr_cluster,
     "copy_to_local": run_copy_to_local_step,
     "mapreduce": run_mapreduce,
+    "report_step": report_step,
+    "clear_result_cache": clear_result_cache,
+    "backfill": run_backfill,
+    "grow_task_group": grow_task_group,
+    "shrink_task_group": shrink_task_group,
     "terminate_emr": terminate_emr_cluster,
     "create_redshift_table": create_redshift_table,
     "copy_output_to_redshift": copy_output_to_redshift,
@@ -263,11 +598,131 @@ orchestrator = {
     "empty_bucket": empty_bucket,
     "vacuum_redshift": vacuum_redshift,
     "analyze_redshift": analyze_redshift,
+    "update_rollups": update_redshift_rollups,
     "delete_output": delete_output_from_bucket
 }
 
+# Inputs of the actions whose outputs are kept in the run state. An action
+# is skipped when a previous run completed it with the same inputs and its
+# outputs are still valid, restoring them (e.g. cluster_id) into defaults.
+checkpoints = {
+    "upload_mapper": lambda: _upload_inputs("/mapreduce/mapper.py", defaults.step_mapper_script),
+    "upload_jar": lambda: _upload_inputs("/mapreduce/mr.jar", "mr.jar"),
+    "upload_copy_to_local": lambda: _upload_inputs("/bash/copy_to_local.sh", defaults.step_copy_to_local_script),
+    "upload_stage_artifacts": lambda: _upload_inputs("/bash/stage_artifacts.sh", defaults.step_stage_artifacts_script),
+    "launch_emr": lambda: {
+        "emr_cluster_name": defaults.emr_cluster_name,
+        "master_type": defaults.master_type,
+        "slave_type": defaults.slave_type,
+        "num_instances": defaults.num_instances,
+        "ami_version": defaults.ami_version,
+        "staged_artifacts": _staged_artifacts(),
+        "use_instance_groups": defaults.use_instance_groups,
+        "task_type": defaults.task_type,
+        "task_instances": defaults.task_instances,
+        "task_bid_price": defaults.task_bid_price
+    },
+    "copy_to_local": lambda: {"cluster_id": defaults.cluster_id, "script": defaults.step_copy_to_local_s3},
+    "copy_output_to_redshift": lambda: {
+        "table_name": defaults.table_name,
+        "output_etags": registry.get("s3").get_etags(_s3_output(_current_output_path()))
+    }
+}
+
+# Checks that the recorded outputs of an action can still be used
+checkpoint_validators = {
+    "upload_mapper": lambda outputs: outputs["etag"] == registry.get("s3").get_etag(defaults.bucket_name, defaults.scripts_remote_path + defaults.step_mapper_script),
+    "upload_jar": lambda outputs: outputs["etag"] == registry.get("s3").get_etag(defaults.bucket_name, defaults.scripts_remote_path + "mr.jar"),
+    "upload_copy_to_local": lambda outputs: outputs["etag"] == registry.get("s3").get_etag(defaults.bucket_name, defaults.scripts_remote_path + defaults.step_copy_to_local_script),
+    "upload_stage_artifacts": lambda outputs: outputs["etag"] == registry.get("s3").get_etag(defaults.bucket_name, defaults.scripts_remote_path + defaults.step_stage_artifacts_script),
+    # reattach to the cluster while it is alive
+    "launch_emr": lambda outputs: _cluster_alive(outputs["cluster_id"]),
+    "copy_to_local": lambda outputs: _cluster_alive(defaults.cluster_id)
+}
+
+# Checkpoints made stale by destructive actions
+invalidations = {
+    "terminate_emr": ["launch_emr", "copy_to_local"],
+    "empty_bucket": ["upload_mapper", "upload_jar", "upload_copy_to_local", "upload_stage_artifacts"],
+    "delete_redshift_table": ["copy_output_to_redshift", "backfill"],
+    "drop_redshift_table": ["copy_output_to_redshift", "backfill"]
+}
+
+# artifacts staged by the bootstrap action for the configured step_type
+def _staged_artifacts():
+    return defaults.staged_artifacts.get(defaults.step_type, [])
+
+def _upload_inputs(local_path, remote_name):
+    current_folder = os.path.dirname(os.path.realpath(__file__))
+    return {
+        "md5": run_state.file_md5(current_folder + local_path),
+        "bucket_name": defaults.bucket_name,
+        "key": defaults.scripts_remote_path + remote_name
+    }
+
+def _mapreduce_inputs(input_path):
+    inputs = {
+        "step_type": defaults.step_type,
+        "input_etags": registry.get("s3").get_etags(input_path)
+    }
+    if defaults.step_type == "jar":
+        inputs["artifact_etags"] = registry.get("s3").get_etags(defaults.step_jar_path)
+        inputs["class_name"] = defaults.step_jar_class_name
+    else:
+        inputs["artifact_etags"] = registry.get("s3").get_etags(defaults.step_mapper)
+        inputs["reducer"] = defaults.step_reducer
+    return inputs
+
+def _cluster_alive(cluster_id):
+    state = registry.get("emr").cluster_state(cluster_id)
+    if state in (u'WAITING', u'RUNNING'):
+        logging.info("Reattaching to cluster " + cluster_id + ". Status: " + state)
+        return True
+    return False
+
+# sentinel values returned by EmrManager when something goes wrong
+def _failed(result):
+    return result in (None, "ERROR", "FAILED", "NOT_FOUND")
+
+# runs the actions in order, recording a span for each of them. The timeline
+# is exported even when an action raises
+def run(actions):
+    try:
+        state = registry.get("run_state")
+        for action in actions:
+            if action not in orchestrator:
+                continue
+            with timeline.span("action." + action) as span:
+                inputs_fingerprint = None
+                if action in checkpoints:
+                    inputs_fingerprint = run_state.fingerprint(checkpoints[action]())
+                    outputs = state.completed(action, inputs_fingerprint)
+                    validator = checkpoint_validators.get(action)
+                    if outputs is not None and (validator is None or validator(outputs)):
+                        for name, value in outputs.items():
+                            if hasattr(defaults, name):
+                                setattr(defaults, name, value)
+                        logging.info("Skipping " + action + ". It was completed by a previous run with the same inputs")
+                        span.set("skipped", True)
+                        continue
+                outputs = orchestrator[action]()
+                if inputs_fingerprint and outputs is not None:
+                    state.record(action, inputs_fingerprint, outputs)
+                if action in invalidations:
+                    state.invalidate(*invalidations[action])
+    finally:
+        # also after a failure, whose error spans are the ones worth looking at
+        export_timeline()
+
+# writes the run timeline and metrics files
+def export_timeline():
+    if defaults.timeline_path:
+        timeline.write_jsonl(_local_path(defaults.timeline_path))
+        logging.info("Run timeline written to " + _local_path(defaults.timeline_path))
+    if defaults.metrics_path:
+        timeline.write_prometheus(_local_path(defaults.metrics_path))
+        logging.info("Run metrics written to " + _local_path(defaults.metrics_path))
+
 if __name__ == '__main__':
     if len(sys.argv) > 1:
-        for action in sys.argv[1:]:
-            if action in orchestrator:
-                orchestrator[action]()
+        run(sys.argv[1:])
@@ -1,5 +1,6 @@
 import logging
 import psycopg2
+from timeline import timeline
 
 # Class for managing a connection to a PosgreSQL database
 class DbConnection(object):
@@ -9,7 +10,8 @@ class DbConnection(object):
         self.cursor = None
         try:
             logging.info("Trying to connect to Redshift db: " + parameters["db_host"])
-            connection = psycopg2.connect("dbname='" + parameters["db_name"] + "' user='" + parameters["db_user"] + "' host='" + parameters["db_host"] + "' password='" + parameters["db_password"] + "' port='" + parameters["db_port"] + "'")
+            with timeline.span("sql.connect", host=parameters["db_host"]):
+                connection = psycopg2.connect("dbname='" + parameters["db_name"] + "' user='" + parameters["db_user"] + "' host='" + parameters["db_host"] + "' password='" + parameters["db_password"] + "' port='" + parameters["db_port"] + "'")
             connection.autocommit = True
             # Create connection    
             self.cursor = connection.cursor()
@@ -19,4 +21,19 @@ class DbConnection(object):
             logging.error(error.diag.message_detail)
         except:
             logging.error("Something went wrong initializing S3Manager")
-            sys.exit()
\ No newline at end of file
+            sys.exit()
+
+    # Executes a SQL statement. Only the leading keywords are recorded in the
+    # timeline, since statements like COPY carry credentials.
+    def execute(self, statement):
+        with timeline.span("sql.execute", statement=" ".join(statement.split()[:2]).upper()) as span:
+            self.cursor.execute(statement)
+            span.set("rows", self.cursor.rowcount)
+
+    # Executes a query and returns its rows
+    def query(self, statement):
+        with timeline.span("sql.query", statement=" ".join(statement.split()[:2]).upper()) as span:
+            self.cursor.execute(statement)
+            rows = self.cursor.fetchall()
+            span.set("rows", len(rows))
+        return rows
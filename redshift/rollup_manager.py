@@ -0,0 +1,149 @@
+import logging
+import sys
+from datetime import datetime
+from timeline import timeline
+
+# Daily rollups of the suppliers table, so dashboards don't run their GROUP
+# BYs over every row ever loaded. Each rollup keeps, per request_date and
+# its grouping columns, the number of requests, the hotels returned and the
+# requests that returned no hotels.
+#
+# Grouping columns are columns of the table, or days_advance_bucket:
+# days_advance rounded down to the closest of days_advance_buckets (-1 when
+# below the first one, e.g. for dates the mapper couldn't parse).
+#
+# Loads go through copy(), which records the request dates they loaded in
+# the load log table, so update() rebuilds exactly those dates without
+# reading the table to find them. A rollup is built from the whole table
+# only when it is created. Both the table and the rollups are sorted by
+# request_date, so the rebuild only reads the blocks of the loaded dates.
+
+MEASURES = [
+    ("requests", "BIGINT", "COUNT(*)"),
+    ("hotels_returned", "BIGINT", "SUM(hotels_returned)"),
+    ("no_hotels", "BIGINT", "SUM(CASE WHEN hotels_returned = 0 THEN 1 ELSE 0 END)")
+]
+COLUMN_TYPES = {
+    "destination": "VARCHAR(1000)",
+    "days_advance": "INTEGER",
+    "hotels_returned": "INTEGER",
+    "days_advance_bucket": "INTEGER"
+}
+
+class RollupManager(object):
+
+    # Default constructor of the class. rollup_tables maps the name of each
+    # rollup to its grouping columns
+    def __init__(self, parameters, connection):
+        try:
+            self.table_name = parameters["table_name"]
+            self.load_log_table = parameters["load_log_table"]
+            self.rollup_tables = parameters["rollup_tables"]
+            self.days_advance_buckets = sorted(parameters["days_advance_buckets"])
+        except:
+            logging.error("Something went wrong initializing RollupManager")
+            sys.exit()
+        self.connection = connection
+
+    # Creates the load log if it doesn't exist yet. Loads need it before copy()
+    def create_load_log(self):
+        self.connection.execute("CREATE TABLE IF NOT EXISTS " + self.load_log_table + " (request_date VARCHAR(10) NOT NULL, loaded_at TIMESTAMP NOT NULL)")
+
+    # Creates the load log and the rollup tables that don't exist yet.
+    # Returns the names of the rollups created
+    def create_tables(self):
+        self.create_load_log()
+        existing = set(name for name, in self.connection.query("SELECT table_name FROM information_schema.tables WHERE table_name IN (" +
+                                                                _sql_list(list(self.rollup_tables)) + ")"))
+        created = []
+        for rollup_name, columns in sorted(self.rollup_tables.items()):
+            if rollup_name in existing:
+                continue
+            definitions = ["request_date VARCHAR(10) NOT NULL"]
+            definitions += [column + " " + COLUMN_TYPES[column] + " NOT NULL" for column in columns]
+            definitions += [name + " " + column_type + " NOT NULL" for name, column_type, expression in MEASURES]
+            self.connection.execute("CREATE TABLE " + rollup_name + " (" + ", ".join(definitions) + ") SORTKEY(request_date)")
+            created.append(rollup_name)
+        return created
+
+    # Copies into the table through a staging table, recording the request
+    # dates of the rows in the load log, all in one transaction. copy_options
+    # is what follows the table name in the COPY statement. connection is the
+    # one of the calling thread
+    def copy(self, connection, copy_options):
+        staging_table = self.table_name + "_staging"
+        loaded_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")
+        connection.execute("BEGIN")
+        try:
+            connection.execute("CREATE TEMP TABLE " + staging_table + " (LIKE " + self.table_name + ")")
+            connection.execute("COPY " + staging_table + copy_options)
+            connection.execute("INSERT INTO " + self.table_name + " SELECT * FROM " + staging_table)
+            connection.execute("INSERT INTO " + self.load_log_table + " SELECT DISTINCT request_date, CAST('" + loaded_at + "' AS TIMESTAMP) FROM " + staging_table)
+            connection.execute("DROP TABLE " + staging_table)
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+
+    # Rebuilds the dates loaded since the last update in every rollup, and
+    # new rollups from the whole table. Returns the dates updated by rollup
+    def update(self):
+        created = self.create_tables()
+        loads = self.connection.query("SELECT request_date, MAX(loaded_at) FROM " + self.load_log_table + " GROUP BY request_date")
+        loaded_dates = sorted(date for date, loaded_at in loads)
+        all_dates = None
+        if created:
+            all_dates = sorted(date for date, in self.connection.query("SELECT DISTINCT request_date FROM " + self.table_name))
+        updated = {}
+        for rollup_name, columns in sorted(self.rollup_tables.items()):
+            dates = all_dates if rollup_name in created else loaded_dates
+            if dates:
+                with timeline.span("rollup.update", rollup=rollup_name, dates=len(dates)):
+                    self._rebuild(rollup_name, columns, dates)
+            logging.info("Rollup " + rollup_name + ": " + str(len(dates)) + " dates updated")
+            updated[rollup_name] = dates
+        # only once every rollup has them, and not the loads made meanwhile
+        if loads:
+            self.connection.execute("DELETE FROM " + self.load_log_table + " WHERE loaded_at <= '" + str(max(loaded_at for date, loaded_at in loads)) + "'")
+        return updated
+
+    # Empties the rollups and the load log, e.g. when the table is emptied
+    def clear(self):
+        self.create_tables()
+        for table_name in [self.load_log_table] + sorted(self.rollup_tables):
+            self.connection.execute("DELETE FROM " + table_name)
+
+    # Drops the rollups and the load log. They are created again on next use
+    def drop(self):
+        for table_name in [self.load_log_table] + sorted(self.rollup_tables):
+            self.connection.execute("DROP TABLE IF EXISTS " + table_name)
+
+    # SQL expression of a grouping column
+    def expression(self, column):
+        if column != "days_advance_bucket":
+            return column
+        cases = ["WHEN days_advance < " + str(self.days_advance_buckets[0]) + " THEN -1"]
+        for lower, upper in zip(self.days_advance_buckets, self.days_advance_buckets[1:]):
+            cases.append("WHEN days_advance < " + str(upper) + " THEN " + str(lower))
+        return "CASE " + " ".join(cases) + " ELSE " + str(self.days_advance_buckets[-1]) + " END"
+
+    # Replaces the rows of the given dates in one transaction, so readers
+    # never see them missing
+    def _rebuild(self, rollup_name, columns, dates):
+        date_list = _sql_list(dates)
+        selected = ["request_date"] + [self.expression(column) for column in columns]
+        self.connection.execute("BEGIN")
+        try:
+            self.connection.execute("DELETE FROM " + rollup_name + " WHERE request_date IN (" + date_list + ")")
+            self.connection.execute("INSERT INTO " + rollup_name + " (" + ", ".join(["request_date"] + columns + [name for name, column_type, expression in MEASURES]) + ")" +
+                                    " SELECT " + ", ".join(selected + [expression for name, column_type, expression in MEASURES]) +
+                                    " FROM " + self.table_name + " WHERE request_date IN (" + date_list + ")" +
+                                    " GROUP BY " + ", ".join(str(position) for position in range(1, len(selected) + 1)))
+            self.connection.execute("COMMIT")
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+
+
+def _sql_list(values):
+    return ", ".join("'" + value.replace("'", "''") + "'" for value in values)
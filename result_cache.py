@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import time
+
+# Content addressed cache of mapreduce results. Entries are keyed by a hash
+# of the step inputs (input etags, artifact etags and step arguments) and
+# point to the output path the step wrote, together with the etags of its
+# output so callers can check it is still there and unchanged.
+#
+# The cache keeps at most max_entries entries. Adding one more evicts the
+# least recently used, which is returned so its output can be deleted.
+
+class ResultCache(object):
+
+    # Default constructor of the class. Without a path the cache is only kept in memory.
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path) as cache_file:
+                    contents = json.load(cache_file)
+                self.entries = contents["entries"]
+                self.hits = contents["hits"]
+                self.misses = contents["misses"]
+            except (ValueError, KeyError):
+                logging.error("Result cache " + path + " is corrupt. Starting from scratch")
+
+    # Returns the entry for key, None if there is none
+    def get(self, key):
+        return self.entries.get(key)
+
+    # Counts a hit and marks the entry as recently used
+    def hit(self, key):
+        self.hits += 1
+        self.entries[key]["last_used"] = time.time()
+        self.save()
+
+    # Counts a miss
+    def miss(self):
+        self.misses += 1
+        self.save()
+
+    # Adds an entry, with the cluster and step that produced it. Returns the
+    # entries evicted to make room for it
+    def put(self, key, output_path, output_etags, cluster_id=None, step_id=None):
+        now = time.time()
+        self.entries[key] = {"output_path": output_path, "output_etags": output_etags, "cluster_id": cluster_id, "step_id": step_id,
+                             "created": now, "last_used": now}
+        evicted = []
+        while len(self.entries) > self.max_entries:
+            oldest = min(self.entries, key=lambda name: self.entries[name]["last_used"])
+            evicted.append(self.entries.pop(oldest))
+        self.save()
+        return evicted
+
+    # Returns the most recently used entry, None if the cache is empty
+    def latest(self):
+        if not self.entries:
+            return None
+        return max(self.entries.values(), key=lambda entry: entry["last_used"])
+
+    # Removes an entry (e.g. because its output is gone). Returns it
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        self.save()
+        return entry
+
+    # Removes all the entries. Returns them
+    def clear(self):
+        entries = list(self.entries.values())
+        self.entries = {}
+        self.save()
+        return entries
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": float(self.hits) / lookups if lookups else 0.0
+        }
+
+    def save(self):
+        if not self.path:
+            return
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as cache_file:
+            json.dump({"entries": self.entries, "hits": self.hits, "misses": self.misses}, cache_file, indent=2, sort_keys=True)
+        os.rename(temporary_path, self.path)
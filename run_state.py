@@ -0,0 +1,72 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+# Persistent record of the actions completed by previous runs. For each
+# action it keeps a fingerprint of the inputs it ran with and the outputs it
+# produced (cluster id, step id, output etags...), so a rerun can skip it
+# while its inputs are unchanged.
+#
+# Actions are stored by name. Sub-actions use "action:detail" names (e.g.
+# "backfill:20140501") and are invalidated together with their action.
+
+class RunState(object):
+
+    # Default constructor of the class. Without a path the state is only kept in memory.
+    def __init__(self, path):
+        self.path = path
+        self.actions = {}
+        # actions may be recorded from worker threads (e.g. backfill loads)
+        self.lock = threading.RLock()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as state_file:
+                    self.actions = json.load(state_file)
+            except ValueError:
+                logging.error("Run state " + path + " is corrupt. Starting from scratch")
+
+    # Returns the outputs of action if it completed with the same inputs, None otherwise
+    def completed(self, action, fingerprint):
+        entry = self.actions.get(action)
+        if entry is None or entry["fingerprint"] != fingerprint:
+            return None
+        return entry["outputs"]
+
+    # Records that action completed with the given inputs fingerprint and outputs
+    def record(self, action, fingerprint, outputs):
+        with self.lock:
+            self.actions[action] = {"fingerprint": fingerprint, "outputs": outputs}
+            self.save()
+
+    # Forgets actions (and their sub-actions) so they run again
+    def invalidate(self, *actions):
+        with self.lock:
+            for name in list(self.actions):
+                if name in actions or name.split(":")[0] in actions:
+                    del self.actions[name]
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        # write and rename, so a crash never leaves a half written state
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as state_file:
+            json.dump(self.actions, state_file, indent=2, sort_keys=True)
+        os.rename(temporary_path, self.path)
+
+
+# Fingerprint of the inputs of an action
+def fingerprint(inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# md5 of a local file
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as local_file:
+        for chunk in iter(lambda: local_file.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
@@ -0,0 +1,50 @@
+import logging
+import time
+from importlib import import_module
+
+# Registry of lazily created clients. Each service is registered with the
+# module that provides it and a builder; neither the import nor the builder
+# run until the service is used for the first time.
+
+class ServiceRegistry(object):
+
+    # Default constructor of the class.
+    def __init__(self):
+        self.builders = {}
+        self.instances = {}
+        # seconds spent importing the module and building each service
+        self.import_times = {}
+        self.init_times = {}
+
+    # Registers a service. builder receives the imported module and returns the client
+    def register(self, name, module_name, builder):
+        self.builders[name] = (module_name, builder)
+        self.instances.pop(name, None)
+
+    # Returns the service, importing and building it on first use
+    def get(self, name):
+        if name not in self.instances:
+            module_name, builder = self.builders[name]
+            start = time.time()
+            module = import_module(module_name)
+            imported = time.time()
+            self.instances[name] = builder(module)
+            self.import_times[name] = imported - start
+            self.init_times[name] = time.time() - imported
+            logging.debug("Service " + name + " created. Import: %.3fs - init: %.3fs" % (self.import_times[name], self.init_times[name]))
+        return self.instances[name]
+
+    # Builds a new, uncached instance of the service (e.g. one connection per worker thread)
+    def create(self, name):
+        module_name, builder = self.builders[name]
+        return builder(import_module(module_name))
+
+    # True if the service has already been built
+    def is_created(self, name):
+        return name in self.instances
+
+    # Forgets built services so they are created again on next use
+    def reset(self):
+        self.instances = {}
+        self.import_times = {}
+        self.init_times = {}
@@ -0,0 +1,118 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Run timeline. Records a span for every action, API call, poll iteration,
+# upload and SQL statement, and exports them as JSON lines (one span per line)
+# or as a Prometheus text file with totals per span name.
+
+class Span(object):
+
+    def __init__(self, span_id, parent_id, name, attributes):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.status = "ok"
+
+    # Sets an attribute of the span (e.g. bytes, state, rows)
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            "id": self.span_id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "status": self.status,
+            "attributes": self.attributes
+        }
+
+
+class Timeline(object):
+
+    # Default constructor of the class.
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.last_id = 0
+
+    # Records a span around the body of a with statement. Spans opened inside
+    # the body (in the same thread) are recorded as its children.
+    @contextmanager
+    def span(self, name, **attributes):
+        stack = self._stack()
+        with self.lock:
+            self.last_id += 1
+            span_id = self.last_id
+        span = Span(span_id, stack[-1].span_id if stack else None, name, attributes)
+        stack.append(span)
+        try:
+            yield span
+        except:
+            span.status = "error"
+            raise
+        finally:
+            span.duration = time.time() - span.start
+            stack.pop()
+            with self.lock:
+                self.spans.append(span)
+
+    # Forgets all recorded spans
+    def reset(self):
+        with self.lock:
+            self.spans = []
+
+    # Returns the recorded spans with the given name
+    def find(self, name):
+        with self.lock:
+            return [span for span in self.spans if span.name == name]
+
+    # Writes one json object per span, sorted by start time
+    def write_jsonl(self, path):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        with open(path, "w") as output:
+            for span in spans:
+                output.write(json.dumps(span.to_dict(), sort_keys=True) + "\n")
+
+    # Writes duration, count, bytes and error totals per span name in the
+    # Prometheus text exposition format
+    def write_prometheus(self, path, prefix="emr_orchestrator"):
+        totals = {}
+        with self.lock:
+            for span in self.spans:
+                total = totals.setdefault(span.name, {"seconds": 0.0, "count": 0, "bytes": 0, "errors": 0})
+                total["seconds"] += span.duration
+                total["count"] += 1
+                total["bytes"] += span.attributes.get("bytes", 0)
+                if span.status != "ok":
+                    total["errors"] += 1
+        lines = []
+        metrics = [("span_seconds", "summary", "Time spent in each span", "seconds", "_sum"),
+                   ("span_seconds", "summary", None, "count", "_count"),
+                   ("span_bytes_total", "counter", "Bytes transferred in each span", "bytes", ""),
+                   ("span_errors_total", "counter", "Spans that raised an error", "errors", "")]
+        for metric, metric_type, help_text, field, suffix in metrics:
+            if help_text:
+                lines.append("# HELP %s_%s %s" % (prefix, metric, help_text))
+                lines.append("# TYPE %s_%s %s" % (prefix, metric, metric_type))
+            for name in sorted(totals):
+                lines.append('%s_%s%s{span="%s"} %s' % (prefix, metric, suffix, name, totals[name][field]))
+        with open(path, "w") as output:
+            output.write("\n".join(lines) + "\n")
+
+    def _stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+
+# timeline shared by the orchestrator and the managers
+timeline = Timeline()